@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import sys
+import shutil
+import optparse
+import tempfile
+from os import mkdir, chmod
+from os.path import isdir, realpath, expanduser, dirname
+
+import cascadenik
+
+def main(src_files, cache_dir=None, datasources_cfg=None, user_styles=[], verbose=False, **kwargs):
+    """ Given a list of layers files, compile each one to fetch every remote
+        resource it uses into the cache directory, and record them in its
+        manifest for later offline compiles.
+    """
+    if cache_dir is None:
+        cache_dir = expanduser(cascadenik.CACHE_DIR)
+        
+        # only make the cache dir if it wasn't user-provided
+        if not isdir(cache_dir):
+            mkdir(cache_dir)
+            chmod(cache_dir, 0755)
+    
+    # compiled output is thrown away
+    output_dir = tempfile.mkdtemp(prefix='cascadenik-cache-')
+    
+    try:
+        for src_file in src_files:
+            dirs = cascadenik.Directories(output_dir, realpath(cache_dir), dirname(src_file))
+            cascadenik.compile(src_file, dirs, verbose, datasources_cfg=datasources_cfg, user_styles=user_styles)
+            
+            print >> sys.stderr, 'cached:', src_file
+    finally:
+        shutil.rmtree(output_dir)
+    
+    manifest = cascadenik._compile.read_manifest(realpath(cache_dir))
+    print >> sys.stderr, '%d remote resources in %s' % (len(manifest), realpath(cache_dir))
+    
+    return 0
+
+parser = optparse.OptionParser(usage="""%prog [options] <mml> [<mml>...]""", version='%prog ' + cascadenik.__version__)
+
+parser.set_defaults(cache_dir=None, verbose=False, user_styles=[], datasources_cfg=None)
+
+parser.add_option('-c', '--cache-dir', dest='cache_dir',
+                  help='Cache file-based resources (symbols, shapefiles, etc) to this directory. (default: %s)' % cascadenik.CACHE_DIR)
+
+parser.add_option('-d' , '--datasources-config', dest='datasources_cfg',
+                  help='Use the specified .cfg file to provide local overrides to datasources and variables.',
+                  type="string")
+
+parser.add_option('--style', dest='user_styles', action='append',
+                  help='Look for additional styles in the named file, which will override anything provided in the MML. Any number of these can be provided.')
+
+parser.add_option('-v' , '--verbose', dest='verbose',
+                  help='Make a bunch of noise. (default: False)',
+                  action='store_true')
+
+if __name__ == '__main__':
+    (options, args) = parser.parse_args()
+    
+    if not len(args):
+        parser.error('Please specify one or more .mml files')
+
+    for layersfile in args:
+        if not layersfile.endswith('.mml'):
+            parser.error('Input must be an .mml file')
+
+    sys.exit(main(args, **options.__dict__))
@@ -29,7 +29,7 @@ def main(src_file, dest_file, **kwargs):
     mmap = mapnik.Map(1, 1)
     # allow [zoom] filters to work
     mmap.srs = '+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null'
-    load_kwargs = dict([(k, v) for (k, v) in kwargs.items() if k in ('cache_dir', 'scale', 'verbose', 'datasources_cfg', 'user_styles')])
+    load_kwargs = dict([(k, v) for (k, v) in kwargs.items() if k in ('cache_dir', 'scale', 'verbose', 'datasources_cfg', 'user_styles', 'jobs', 'prune_by_data', 'offline', 'cache_budget', 'fetch_budget')])
     cascadenik.load_map(mmap, src_file, dirname(realpath(dest_file)), **load_kwargs)
     
     (handle, tmp_file) = tempfile.mkstemp(suffix='.xml', prefix='cascadenik-mapnik-')
@@ -53,7 +53,7 @@ def main(src_file, dest_file, **kwargs):
 
 parser = optparse.OptionParser(usage="""%prog [options] <mml> <xml>""", version='%prog ' + cascadenik.__version__)
 
-parser.set_defaults(cache_dir=None, pretty=True, verbose=False, scale=1, user_styles=[], datasources_cfg=None)
+parser.set_defaults(cache_dir=None, pretty=True, verbose=False, scale=1, user_styles=[], datasources_cfg=None, jobs=1, prune_by_data=False, offline=False, cache_budget=None, fetch_budget=None)
 
 # the actual default for cache_dir is handled in load_map(),
 # to ensure that the mkdir behavior is correct.
@@ -73,6 +73,26 @@ parser.add_option('--2x', dest='scale', action='store_const', const=2,
 parser.add_option('--style', dest='user_styles', action='append',
                   help='Look for additional styles in the named file, which will override anything provided in the MML. Any number of these can be provided.')
 
+parser.add_option('-j', '--jobs', dest='jobs',
+                  help='Number of worker processes used to generate layer rules. (default: 1)',
+                  type='int')
+
+parser.add_option('--prune-by-data', dest='prune_by_data',
+                  help='Leave out filters that match no features in local shapefile attributes. Output is only correct for the data at compile time. (default: False)',
+                  action='store_true')
+
+parser.add_option('--offline', dest='offline',
+                  help='Take remote resources only from the cache directory, as recorded by cascadenik-cache.py. (default: False)',
+                  action='store_true')
+
+parser.add_option('--cache-budget', dest='cache_budget',
+                  help='Size limit in megabytes for the cache directory. Least-recently used files are removed to fit after compiling. (default: None)',
+                  type='float')
+
+parser.add_option('--fetch-budget', dest='fetch_budget',
+                  help='Time limit in seconds for fetching remote resources, after which compiling fails. Missing or unreachable resources are remembered in the cache directory for a few minutes. (default: None)',
+                  type='float')
+
 parser.add_option('-p', '--pretty', dest='pretty',
                   help='Pretty print the xml output. (default: True)',
                   action='store_true')
@@ -97,4 +117,7 @@ if __name__ == '__main__':
     if not outputfile.endswith('.xml'):
         parser.error('Output must be an .xml file')
 
+    if options.cache_budget is not None:
+        options.cache_budget = int(options.cache_budget * 1024 * 1024)
+
     sys.exit(main(layersfile, outputfile, **options.__dict__))
@@ -32,14 +32,14 @@ from .parse import stylesheet_declarations
 from . import compile as _compile
 
 # compile function -> "compile"
-from .compile import compile, Directories
+from .compile import compile, compile_async, Directories
 
 # define Cascadenik default cache directory
 CACHE_DIR = '~/.cascadenik'
 
-__all__ = ['load_map', 'compile', '_compile', 'style', 'stylesheet_declarations']
+__all__ = ['load_map', 'compile', 'compile_async', '_compile', 'style', 'stylesheet_declarations']
 
-def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg=None, user_styles=[], verbose=False):
+def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg=None, user_styles=[], verbose=False, jobs=1, prune_by_data=False, offline=False, cache_budget=None, fetch_budget=None):
     """ Apply a stylesheet source file to a given mapnik Map instance, like mapnik.load_map().
     
         Parameters:
@@ -72,6 +72,22 @@ def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg
         
           verbose:
             ...
+        
+          jobs:
+            Number of worker processes used to generate layer rules.
+        
+          prune_by_data:
+            Leave out filters that match no features in local shapefiles.
+        
+          offline:
+            Take remote resources only from the cache directory, as recorded
+            by an earlier compile or cascadenik-cache.py.
+        
+          cache_budget:
+            Optional size limit in bytes for the cache directory.
+        
+          fetch_budget:
+            Optional limit in seconds on the time spent fetching remote resources.
     """
     scheme, n, path, p, q, f = urlparse(src_file)
     
@@ -87,4 +103,4 @@ def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg
             chmod(cache_dir, 0755)
 
     dirs = Directories(output_dir, realpath(cache_dir), dirname(src_file))
-    compile(src_file, dirs, verbose, datasources_cfg=datasources_cfg, user_styles=user_styles, scale=scale).to_mapnik(map, dirs)
+    compile(src_file, dirs, verbose, datasources_cfg=datasources_cfg, user_styles=user_styles, scale=scale, jobs=jobs, prune_by_data=prune_by_data, offline=offline, cache_budget=cache_budget, fetch_budget=fetch_budget).to_mapnik(map, dirs)
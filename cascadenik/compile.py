@@ -10,10 +10,19 @@ import posixpath
 import os.path as systempath
 import zipfile
 import shutil
-
+import pickle
+import random
+import socket
+import httplib
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+from copy import copy
 from hashlib import md5
 from datetime import datetime
-from time import strftime, localtime
+from time import time, sleep
+from email.utils import formatdate
 from re import sub, compile, MULTILINE
 from urlparse import urlparse, urljoin
 from operator import lt, le, eq, ge, gt
@@ -54,12 +63,23 @@ else:
 
 
 # cascadenik
-from . import safe64, style, output, sources
+from . import safe64, style, output, sources, dbf
 from . import MAPNIK_VERSION, MAPNIK_VERSION_STR
 from .nonposix import un_posix, to_posix
 from .parse import stylesheet_declarations
 from .style import uri
 
+try:
+    import numpy
+except ImportError:
+    numpy = False
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks, e.g. on Windows
+    fcntl = False
+
 try:
     from PIL import Image
 except ImportError:
@@ -88,18 +108,224 @@ except ImportError:
 opsort = {lt: 1, le: 2, eq: 3, ge: 4, gt: 5}
 opstr = {lt: '<', le: '<=', eq: '==', ge: '>=', gt: '>'}
 
-VERBOSE = False
+# kinds of styles made by get_layer_rules()
+STYLE_KINDS = ('raster', 'polygon', 'polygon pattern', 'line', 'line pattern', 'shield', 'text', 'point')
 
-def msg(msg):
-    if VERBOSE:
-        sys.stderr.write('Cascadenik debug: %s\n' % msg)
+# property name prefixes used by each kind of style, generously
+STYLE_KIND_PREFIXES = (('raster-', 'raster'), ('polygon-', 'polygon'),
+                       ('polygon-', 'polygon pattern'), ('line-', 'line'),
+                       ('inline-', 'line'), ('outline-', 'line'),
+                       ('line-pattern-', 'line pattern'), ('shield-', 'shield'),
+                       ('text-', 'text'), ('point-', 'point'))
+
+class CompileContext:
+    """ Options and state for a single run of compile().
+    
+        Carries verbosity, rule generation options, the sequential ID
+        generator for style and layer names, caches and metrics, so that
+        separate compiles can run at the same time on separate threads.
+        
+        Keyword Parameters:
+        
+          verbose:
+            If True, debugging information will be printed to stderr.
+        
+          else_filters:
+            If True, catch-all rules that would otherwise need a long chain of
+            "not [foo] = 'bar'" expressions are output with an ElseFilter.
+        
+          merge_rules:
+            If True, rules with identical symbolizers that differ only in the
+            value of one attribute are merged into a single rule, using a regular
+            expression match in Mapnik 2.0.0 and later when it's expected to be
+            cheaper than a chain of "or" clauses.
+        
+          use_numpy:
+            If True, use NumPy to match declarations to filters in bulk.
+            Output is identical, but large stylesheets compile faster.
+        
+          optimize_cascade:
+            If True, declarations that can't change the outcome of the cascade
+            are dropped before filters are combined, along with any tests
+            found only in those declarations.
+        
+          cache_dir:
+            Optional directory where filter combinations are saved and reused
+            by later compiles with the same selector tests, such as after edits
+            that only change colors or widths.
+        
+          prune_by_data:
+            If True, attribute values are read from the .dbf files of local
+            shapefile datasources, and filters that would match no features
+            there are left out. Output is only correct for the data as it
+            was at compile time.
+        
+          filter_engine:
+            Optional FilterEngine, or the name of one in FILTER_ENGINES, used
+            to make filter combinations and rules. "differential" runs the
+            numpy and reference engines together and raises an exception if
+            they disagree. Overrides use_numpy.
+        
+          fetch_threads:
+            Number of threads used to fetch remote stylesheets, configs,
+            datasource files and images all at once before compiling.
+            Zero fetches each one only when it's needed.
+        
+          connections:
+            Optional ConnectionPool for remote requests.
+        
+          offline:
+            If True, nothing is fetched. Remote resources are taken from
+            the cache directory using the manifest written by earlier
+            compiles, see cascadenik-cache.py. An exception lists every
+            missing one.
+        
+          cache_budget:
+            Optional size limit in bytes for the cache directory. After
+            compiling, least-recently used files are removed until it fits,
+            except for those used by this compile.
+        
+          fetch_budget:
+            Optional limit in seconds on the time spent fetching remote
+            resources. Once it's used up, fetching raises an exception.
+    """
+    def __init__(self, verbose=False, else_filters=False, merge_rules=False, use_numpy=False, optimize_cascade=False, cache_dir=None, prune_by_data=False, filter_engine=None, fetch_threads=4, connections=None, offline=False, cache_budget=None, fetch_budget=None):
+        self.verbose = verbose
+        self.else_filters = else_filters
+        self.merge_rules = merge_rules
+        self.use_numpy = use_numpy
+        self.optimize_cascade = optimize_cascade
+        
+        # FilterEngine that makes filter combinations and rules from them
+        if filter_engine is None:
+            filter_engine = use_numpy and 'numpy' or 'reference'
+        
+        if isinstance(filter_engine, basestring):
+            filter_engine = FILTER_ENGINES[filter_engine]()
+        
+        self.filter_engine = filter_engine
+        
+        # directory for filter combinations that outlive this compile
+        self.cache_dir = cache_dir
+        
+        # whether to drop filters that match no features in local data
+        self.prune_by_data = prune_by_data
+        
+        # attribute values found in one layer's data, see shapefile_feature_values()
+        self.feature_values = None
+        
+        # filters made from ranked tests, see ranked_filter_combinations()
+        self.filter_combinations = {}
+        
+        # number of threads used by prefetch(), or zero to fetch lazily
+        self.fetch_threads = fetch_threads
+        
+        # remote stylesheet and config content, by URL
+        self.remote_texts = {}
+        
+        # local paths of remote files from locally_cache_remote_file(), by URL
+        self.remote_files = {}
+        
+        # exceptions from remote resources that failed in prefetch(), by URL
+        self.remote_failures = {}
+        
+        # keep-alive connections to remote hosts, see connection_pool()
+        self.connections = connections
+        
+        # nothing is fetched after fetch_budget seconds from now
+        self.fetch_deadline = fetch_budget is not None and time() + fetch_budget or None
+        
+        # whether remote files come only from the cache manifest, see read_manifest()
+        self.offline = offline
+        self.manifest = None
+        
+        # size limit in bytes for the cache directory, see evict_cache_entries()
+        self.cache_budget = cache_budget
+        
+        # cached files used by this compile, which must not be evicted
+        self.cache_paths = set()
+        
+        # shared locks on cache entries used by this compile, see hold_cache_entry()
+        self.cache_locks = {}
+        
+        # last ID handed out by next_id()
+        self.last_id = 0
+        
+        # generated rules for each unique set of layer declarations
+        self.layer_rules = {}
+        
+        # styles with identical rules are shared among layers, by fingerprint
+        self.shared_styles = {}
+        
+        # counts of things that happened, by name
+        self.metrics = {}
+    
+    def __getstate__(self):
+        """ Leave caches behind when sent to a worker process.
+        """
+        state = self.__dict__.copy()
+        state.update(layer_rules={}, shared_styles={})
+        
+        # entries stay locked by this process, but its lock files stay behind
+        state.update(cache_locks=dict.fromkeys(self.cache_locks))
+        return state
+    
+    def connection_pool(self):
+        """ Return the ConnectionPool for remote requests, made when first needed.
+        """
+        contexts_lock.acquire()
+        
+        try:
+            if self.connections is None:
+                self.connections = ConnectionPool(deadline=self.fetch_deadline)
+            
+            return self.connections
+        finally:
+            contexts_lock.release()
+    
+    def msg(self, msg):
+        if self.verbose:
+            sys.stderr.write('Cascadenik debug: %s\n' % msg)
+    
+    def next_id(self):
+        self.last_id += 1
+        return self.last_id
+    
+    def count(self, name, amount=1):
+        self.metrics[name] = self.metrics.get(name, 0) + amount
+
+# context of the compile() running in each thread
+contexts = threading.local()
+contexts_lock = threading.Lock()
 
-counter = 0
+# connections shared by everything called outside of compile(), see current_context()
+default_connections = None
+
+def current_context():
+    """ Return the CompileContext of the compile() running in this thread,
+        or a new quiet one if there isn't one.
+        
+        Outside of compile(), nothing fetched is remembered from one call to
+        the next, but keep-alive connections are shared by all of them.
+    """
+    global default_connections
+    
+    if getattr(contexts, 'current', None) is not None:
+        return contexts.current
+    
+    contexts_lock.acquire()
+    
+    try:
+        if default_connections is None:
+            default_connections = ConnectionPool()
+    finally:
+        contexts_lock.release()
+    
+    return CompileContext(connections=default_connections)
 
-def next_counter():
-    global counter
-    counter += 1
-    return counter
+def msg(msg):
+    if getattr(contexts, 'current', None) is not None:
+        contexts.current.msg(msg)
 
 def url2fs(url):
     """ encode a URL to be safe as a filename """
@@ -584,6 +810,116 @@ def tests_filter_combinations(tests):
     # if no filters have been defined, return a blank one that matches anything
     return [Filter()]
 
+# part of the name of each cached_filter_combinations() file, changed when their contents do
+FILTER_CACHE_VERSION = 1
+
+def cached_filter_combinations(tests, cache_dir, engine=None):
+    """ Return filter combinations for a list of tests, saving each result
+        to a file in the cache directory named for the tests.
+        
+        Combinations are made by the given FilterEngine, or the reference one.
+        
+        Combinations depend only on the tests and their order, so palette and
+        width changes to a stylesheet will find them here on later compiles.
+        
+        A cache file that can't be read is treated as missing, and one that
+        can't be written is left out.
+    """
+    test_tuples = [(test.property, test.op, test.value) for test in tests]
+    
+    cache_dir = posixpath.join(cache_dir, 'filter-combinations')
+    cache_path = posixpath.join(cache_dir, md5(repr((FILTER_CACHE_VERSION, test_tuples))).hexdigest() + '.pickle')
+    
+    try:
+        cache_file = open(un_posix(cache_path), 'rb')
+        filters_tuples = pickle.load(cache_file)
+        cache_file.close()
+        
+        filters = [Filter(*[style.SelectorAttributeTest(*test_tuple) for test_tuple in filter_tuples])
+                   for filter_tuples in filters_tuples]
+        
+    except Exception:
+        # missing, truncated, or written by some other version
+        pass
+    
+    else:
+        msg('Read %d filter combinations from %s' % (len(filters), cache_path))
+        return filters
+    
+    filters = (engine or FilterEngine()).filter_combinations(tests)
+    filters_tuples = [[(test.property, test.op, test.value) for test in filter.tests] for filter in filters]
+    
+    try:
+        if not posixpath.exists(cache_dir):
+            try:
+                os.makedirs(un_posix(cache_dir))
+            except OSError:
+                # someone else might have just made it
+                pass
+        
+        write_file_atomically(cache_path, pickle.dumps(filters_tuples, pickle.HIGHEST_PROTOCOL))
+    
+    except (IOError, OSError), e:
+        msg('Failed to save filter combinations to %s: %s' % (cache_path, e))
+    
+    return filters
+
+def ranked_filter_combinations(tests, context):
+    """ Return filter combinations for a list of tests, made just once per
+        compile for lists that differ only in their scale values.
+        
+        Combinations depend only on the order of scale-denominator and zoom
+        values, so they're made with each value replaced by its rank and the
+        real values are put back afterwards. Maps compiled at several scales
+        share combinations this way.
+    """
+    scale_values, ranks, values = {}, {}, {}
+    
+    for test in tests:
+        if test.property in ('scale-denominator', 'zoom') and test.isNumeric():
+            scale_values.setdefault(test.property, set()).add((test.value, type(test.value)))
+    
+    for (property, property_values) in scale_values.items():
+        if len(set([value for (value, type_) in property_values])) < len(property_values):
+            # equal values of different types, e.g. 1 and 1.0, can't share a rank
+            ranks, values = {}, {}
+            break
+        
+        for (rank, (value, type_)) in enumerate(sorted(property_values)):
+            ranks[(property, value)], values[(property, rank)] = rank, value
+    
+    ranked_tests = [style.SelectorAttributeTest(test.property, test.op, ranks[(test.property, test.value)])
+                    if (test.property, test.value) in ranks else test
+                    for test in tests]
+    
+    # test order follows the real values, see selectors_tests(), but doesn't
+    # matter for ranged tests because test_ranges() sorts them anyway.
+    ranged = set([test.property for test in ranked_tests if test.isRanged()]) & set(scale_values)
+    ranked_tests = sorted([test for test in ranked_tests if test.property in ranged], key=lambda test: (test.property, test.value, test.op)) \
+                 + [test for test in ranked_tests if test.property not in ranged]
+    
+    key = tuple([(test.property, test.op, test.value, type(test.value)) for test in ranked_tests])
+    
+    if key in context.filter_combinations:
+        context.count('reused filter combinations')
+    
+    elif context.cache_dir:
+        context.filter_combinations[key] = cached_filter_combinations(ranked_tests, context.cache_dir, context.filter_engine)
+        context.count('filter combinations')
+    
+    else:
+        context.filter_combinations[key] = context.filter_engine.filter_combinations(ranked_tests)
+        context.count('filter combinations')
+    
+    if not ranks:
+        return list(context.filter_combinations[key])
+    
+    # rank order is value order, so the filters stay sorted
+    return [Filter(*[style.SelectorAttributeTest(test.property, test.op, values[(test.property, test.value)])
+                     if (test.property, test.value) in values else test
+                     for test in filter.tests])
+            for filter in context.filter_combinations[key]]
+
 def is_merc_projection(srs):
     """ Return true if the map projection matches that used by VEarth, Google, OSM, etc.
     
@@ -629,7 +965,7 @@ def extract_declarations(map_el, dirs, scale=1, user_styles=[]):
     #
     for stylesheet in user_styles:
         mss_href = urljoin(dirs.source.rstrip('/')+'/', stylesheet)
-        content = urllib.urlopen(mss_href).read().decode(DEFAULT_ENCODING)
+        content = fetch_remote_text(mss_href, dirs.cache)
 
         styles.append((content, mss_href))
     
@@ -661,13 +997,39 @@ def fetch_embedded_or_remote_src(elem, dirs):
     if 'src' in elem.attrib:
         scheme, host, remote_path, p, q, f = urlparse(dirs.source)
         src_href = urljoin(dirs.source.rstrip('/')+'/', elem.attrib['src'])
-        return urllib.urlopen(src_href).read().decode(DEFAULT_ENCODING), src_href
+        return fetch_remote_text(src_href, dirs.cache), src_href
 
     elif elem.text:
         return elem.text, dirs.source.rstrip('/')+'/'
     
     return None, None
 
+def fetch_remote_text(href, cache_dir=None):
+    """ Return the decoded content of a stylesheet or config file, fetching
+        it only if the current context hasn't already done so.
+        
+        Remote files are kept in the cache directory, if one is given.
+    """
+    context = current_context()
+    texts = context.remote_texts
+    
+    if href in texts:
+        return texts[href]
+    
+    if href in context.remote_failures:
+        # already failed during this compile, e.g. in prefetch()
+        raise context.remote_failures[href]
+    
+    if cache_dir and urlparse(href)[0] in ('http', 'https'):
+        file = open(un_posix(locally_cache_remote_file(href, cache_dir)), 'rb')
+    else:
+        file = urllib.urlopen(href)
+    
+    texts[href] = file.read().decode(DEFAULT_ENCODING)
+    file.close()
+    
+    return texts[href]
+
 def expand_source_declarations(map_el, dirs, local_conf):
     """ This provides mechanism for externalizing and sharing data sources.  The datasource configs are
     python files, and layers reference sections within that config:
@@ -681,7 +1043,7 @@ def expand_source_declarations(map_el, dirs, local_conf):
 
     
     
-    ds = sources.DataSources(dirs.source, local_conf)
+    ds = sources.DataSources(dirs.source, local_conf, dirs.cache)
 
     # build up the configuration
     for spec in map_el.findall('DataSourcesConfig'):
@@ -730,10 +1092,39 @@ def expand_source_declarations(map_el, dirs, local_conf):
         layer.append(b)
         del layer.attrib['source_name']
         
+# rough relative costs of evaluating Mapnik filter expressions, used to
+# decide when one regular expression beats a chain of "or" equality tests.
+EQUALITY_COST = 1.0
+REGEX_COST = 2.5
+
+def is_regex_cheaper(values):
+    """ Return true if a single regular expression match is expected to be
+        cheaper than a disjunction of equality tests for a list of values.
+    """
+    if MAPNIK_VERSION < 200000:
+        # expression .match() arrived in Mapnik 2.0.0
+        return False
+    
+    if False in [type(value) in (str, unicode) for value in values]:
+        return False
+    
+    return REGEX_COST < EQUALITY_COST * len(values)
+
 def test2str(test):
     """ Return a mapnik-happy Filter expression atom for a single test
+    
+        Equality tests with a tuple of alternative values are expressed
+        as a regular expression match or a parenthesized disjunction.
     """
-    if type(test.value) in (int, float):
+    if type(test.value) is tuple and test.op == '=':
+        if is_regex_cheaper(test.value):
+            pattern = '|'.join([sub(r'([\\.^$|?*+()\[\]{}])', r'\\\1', value) for value in test.value])
+            return "[%s].match('^(%s)$')" % (test.property, pattern)
+        
+        tests = [style.SelectorAttributeTest(test.property, '=', value) for value in test.value]
+        return '(%s)' % ' or '.join(map(test2str, tests))
+    
+    elif type(test.value) in (int, float):
         value = str(test.value)
     elif type(test.value) in (str, unicode):
         value = "'%s'" % test.value
@@ -784,6 +1175,163 @@ def make_rule(filter, *symbolizers):
     
     return rule
 
+def is_else_filter(filter, filters):
+    """ Given a Filter and the list of Filters that share its scale range,
+        return True if the Filter is nothing but the negation of all the others.
+
+        This is only the case when every other combination of values
+        is present in the list, so it's safe to replace with an ElseFilter.
+    """
+    tests = [test for test in filter.tests if not test.isMapScaled()]
+
+    if not tests or False in [test.op == '!=' for test in tests]:
+        return False
+
+    # the complete set of negated values for each property
+    values = {}
+
+    for test in tests:
+        if test.property not in values:
+            values[test.property] = set()
+
+        values[test.property].add(test.value)
+
+    properties = set([test.property for other in filters
+                      for test in other.tests if not test.isMapScaled()])
+
+    if properties != set(values.keys()):
+        return False
+
+    # each property contributes one combination per value, plus this negation.
+    return len(filters) == reduce(operator.mul, [len(v) + 1 for v in values.values()])
+
+def else_filter_rules(filtered_rules):
+    """ Given a list of (Filter, output.Rule) pairs, return a new list where
+        catch-all rules made entirely of negations are given an ElseFilter
+        wherever the remaining rules in the same scale range account for
+        every other combination of values.
+    """
+    scale_filters = {}
+
+    for (filter, rule) in filtered_rules:
+        key = tuple(sorted([unicode(test) for test in filter.tests if test.isMapScaled()]))
+        scale_filters.setdefault(key, []).append(filter)
+
+    pairs = []
+
+    for (filter, rule) in filtered_rules:
+        key = tuple(sorted([unicode(test) for test in filter.tests if test.isMapScaled()]))
+
+        if is_else_filter(filter, scale_filters[key]):
+            msg('Using ElseFilter in place of %s' % rule.filter)
+            rule = output.Rule(rule.minscale, rule.maxscale, output.ElseFilter(), rule.symbolizers)
+
+        pairs.append((filter, rule))
+
+    return pairs
+
+def symbolizer_signature(symbolizer):
+    """ Return a hashable summary of a symbolizer's type and attributes,
+        suitable for finding symbolizers that are identical to one another.
+    """
+    attributes = [(key, value.__class__.__name__, repr(getattr(value, '__dict__', value)))
+                  for (key, value) in symbolizer.__dict__.items()]
+    
+    return symbolizer.__class__.__name__, tuple(sorted(attributes))
+
+def merged_alternative_rules(filtered_rules):
+    """ Given a list of (Filter, output.Rule) pairs, return a new list where
+        rules with identical symbolizers whose filters differ only in the
+        value of a single "=" test are merged into one rule.
+    
+        Merged rules carry a tuple of alternative values for that test,
+        which test2str() expresses as a regular expression or disjunction.
+    """
+    # group membership, and the candidate groups for each rule.
+    group_indexes, groups, options = {}, [], []
+    
+    for (index, (filter, rule)) in enumerate(filtered_rules):
+        options.append([])
+        
+        if rule.filter.__class__ is not output.Filter:
+            continue
+        
+        symbolizers = tuple(map(symbolizer_signature, rule.symbolizers))
+        properties = sorted(set([test.property for test in filter.tests if not test.isMapScaled()]))
+        
+        for property in properties:
+            tests = [test for test in filter.tests if test.property == property]
+            
+            if len(tests) != 1 or tests[0].op != '=' or type(tests[0].value) is tuple:
+                continue
+            
+            others = tuple(sorted([unicode(test) for test in filter.tests if test.property != property]))
+            key = (property, others, symbolizers)
+            
+            if key not in group_indexes:
+                group_indexes[key] = len(groups)
+                groups.append((property, []))
+            
+            groups[group_indexes[key]][1].append(index)
+            options[index].append(group_indexes[key])
+    
+    # settle each rule into the largest group it can join.
+    chosen = [None] * len(filtered_rules)
+    
+    for (index, candidates) in enumerate(options):
+        candidates = [g for g in candidates if len(groups[g][1]) > 1]
+        
+        if candidates:
+            chosen[index] = max(candidates, key=lambda g: (len(groups[g][1]), -g))
+    
+    pairs = []
+    
+    for (index, (filter, rule)) in enumerate(filtered_rules):
+        if chosen[index] is None:
+            pairs.append((filter, rule))
+            continue
+        
+        property, members = groups[chosen[index]]
+        members = [i for i in members if chosen[i] == chosen[index]]
+        
+        if len(members) == 1:
+            pairs.append((filter, rule))
+            continue
+        
+        elif index != members[0]:
+            # already merged into an earlier rule
+            continue
+        
+        values = tuple([test.value for i in members
+                        for test in filtered_rules[i][0].tests if test.property == property])
+        
+        tests = [test for test in filter.tests if test.property != property]
+        merged = Filter(*(tests + [style.SelectorAttributeTest(property, '=', values)]))
+        
+        msg('Merging %d rules into %s' % (len(members), merged))
+        pairs.append((merged, make_rule(merged, *rule.symbolizers)))
+    
+    return pairs
+
+def make_rules(filtered_rules, context=None):
+    """ Given a list of (Filter, output.Rule) pairs, return a list of output.Rule objects.
+
+        If context.else_filters is True, catch-all rules made entirely of
+        negations are replaced with an ElseFilter where it's safe to do so.
+        
+        If context.merge_rules is True, rules that differ only in the value
+        of a single attribute are merged into one rule.
+    """
+    context = context or CompileContext()
+    
+    if context.else_filters:
+        filtered_rules = else_filter_rules(filtered_rules)
+    
+    if context.merge_rules:
+        filtered_rules = merged_alternative_rules(filtered_rules)
+
+    return [rule for (filter, rule) in filtered_rules]
+
 def is_applicable_selector(selector, filter):
     """ Given a Selector and Filter, return True if the Selector is
         compatible with the given Filter, and False if they contradict.
@@ -803,19 +1351,105 @@ def get_map_attributes(declarations):
                  for dec in declarations
                  if dec.property.name in property_map])
 
-def filtered_property_declarations(declarations, property_names):
-    """
+def numpy_filtered_declarations(filters, declarations):
+    """ Given a list of filters and a list of declarations in cascade order,
+        return a list of (filter, rule) pairs like filtered_property_declarations().
+    
+        Uses NumPy to decide which declarations apply to which filters all at
+        once: each unique selector test and filter test gets a numeric code,
+        contradictions between pairs of them are found with isCompatible(),
+        and the rest is matrix arithmetic.
     """
-    property_names += ['display']
-
-    # just the ones we care about here
-    declarations = [dec for dec in declarations if dec.property.name in property_names]
-    selectors = [dec.selector for dec in declarations]
+    def test_key(test):
+        return test.property, test.op, repr(test.value)
+    
+    selector_tests, filter_tests = {}, {}
+    
+    for dec in declarations:
+        for test in dec.selector.allTests():
+            selector_tests[test_key(test)] = test
+    
+    for filter in filters:
+        for test in filter.tests:
+            filter_tests[test_key(test)] = test
+    
+    selector_keys, filter_keys = sorted(selector_tests.keys()), sorted(filter_tests.keys())
+    selector_codes = dict([(key, i) for (i, key) in enumerate(selector_keys)])
+    filter_codes = dict([(key, i) for (i, key) in enumerate(filter_keys)])
+    
+    # contradictions between single selector tests and single filter tests
+    conflicts = numpy.zeros((len(selector_keys), len(filter_keys)), dtype=numpy.int32)
+    
+    for (i, key) in enumerate(selector_keys):
+        test = selector_tests[key]
+    
+        for (j, other_key) in enumerate(filter_keys):
+            other = filter_tests[other_key]
+        
+            if test.property == other.property and not test.isCompatible([other]):
+                conflicts[i, j] = 1
+    
+    # which tests appear in which filters and selectors
+    filter_incidence = numpy.zeros((len(filters), len(filter_keys)), dtype=numpy.int32)
+    selector_incidence = numpy.zeros((len(declarations), len(selector_keys)), dtype=numpy.int32)
+    
+    for (i, filter) in enumerate(filters):
+        for test in filter.tests:
+            filter_incidence[i, filter_codes[test_key(test)]] = 1
+    
+    for (i, dec) in enumerate(declarations):
+        for test in dec.selector.allTests():
+            selector_incidence[i, selector_codes[test_key(test)]] = 1
+    
+    # a selector applies to a filter when none of its tests are contradicted.
+    contradicted = (numpy.dot(filter_incidence, conflicts.T) > 0).astype(numpy.int32)
+    applicable = numpy.dot(contradicted, selector_incidence.T) == 0
+    
+    # presence of display: none means don't add a rule at all.
+    hidden = numpy.zeros(len(filters), dtype=bool)
+    
+    for (i, dec) in enumerate(declarations):
+        if (dec.property.name, dec.value.value) == ('display', 'none'):
+            hidden |= applicable[:, i]
+    
+    # the winning declaration for each property is the last applicable one.
+    columns = {}
+    
+    for (i, dec) in enumerate(declarations):
+        if dec.property.name != 'display':
+            columns.setdefault(dec.property.name, []).append(i)
+    
+    winners = []
+    
+    for (name, indexes) in columns.items():
+        indexes = numpy.array(indexes)
+        property_applicable = applicable[:, indexes]
+        last = len(indexes) - 1 - numpy.argmax(property_applicable[:, ::-1], axis=1)
+        winners.append((name, property_applicable.any(axis=1), indexes[last]))
+    
+    rules = []
+    
+    for (i, filter) in enumerate(filters):
+        if hidden[i]:
+            continue
+        
+        rule = dict([(name, declarations[index[i]].value)
+                     for (name, present, index) in winners if present[i]])
+        
+        if rule:
+            rules.append((filter, rule))
+    
+    return rules
 
+def reference_filtered_declarations(filters, declarations):
+    """ Given a list of filters and a list of declarations in cascade order,
+        return a list of (filter, rule) pairs, one for each filter that
+        gets any properties.
+    """
     # a place to put rules
     rules = []
     
-    for filter in tests_filter_combinations(selectors_tests(selectors)):
+    for filter in filters:
         rule = {}
         
         # collect all the applicable declarations into a list of parameters and values
@@ -841,65 +1475,275 @@ def filtered_property_declarations(declarations, property_names):
     
     return rules
 
-def get_polygon_rules(declarations):
-    """ Given a Map element, a Layer element, and a list of declarations,
-        create a new Style element with a PolygonSymbolizer, add it to Map
-        and refer to it in Layer.
-    """
-    property_map = {'polygon-fill': 'fill', 'polygon-opacity': 'fill-opacity',
-                    'polygon-gamma': 'gamma',
-                    'polygon-meta-output': 'meta-output', 'polygon-meta-writer': 'meta-writer'}
-
-    property_names = property_map.keys()
+class FilterEngine:
+    """ Reference engine for the two steps of turning declarations into rules:
+        making every combination of tests into filters, then deciding which
+        declarations apply to each filter.
     
-    # a place to put rules
-    rules = []
+        Other engines subclass this and replace either step. They must return
+        the same filters in the same order and the same (filter, rule) pairs,
+        which DifferentialFilterEngine can check.
+    """
+    name = 'reference'
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
-        color = values.has_key('polygon-fill') and values['polygon-fill'].value
-        opacity = values.has_key('polygon-opacity') and values['polygon-opacity'].value or None
-        gamma = values.has_key('polygon-gamma') and values['polygon-gamma'].value or None
-        symbolizer = color and output.PolygonSymbolizer(color, opacity, gamma)
-        
-        if symbolizer:
-            rules.append(make_rule(filter, symbolizer))
+    def filter_combinations(self, tests):
+        """ Return a sorted list of filters for a list of tests.
+        """
+        return tests_filter_combinations(tests)
     
-    return rules
+    def filtered_declarations(self, filters, declarations):
+        """ Return a list of (filter, rule) pairs for lists of filters and declarations.
+        """
+        return reference_filtered_declarations(filters, declarations)
 
-def get_raster_rules(declarations):
-    """ Given a Map element, a Layer element, and a list of declarations,
-        create a new Style element with a RasterSymbolizer, add it to Map
-        and refer to it in Layer.
-        
-        The RasterSymbolizer will always created, even if there are
-        no applicable declarations.
+class NumpyFilterEngine(FilterEngine):
+    """ Engine that applies declarations to filters with matrix arithmetic,
+        see numpy_filtered_declarations().
     """
-    property_map = {'raster-opacity': 'opacity',
-                    'raster-mode': 'mode',
-                    'raster-scaling': 'scaling'
-                    }
-
-    property_names = property_map.keys()
-
-    # a place to put rules
-    rules = []
+    name = 'numpy'
+    
+    def __init__(self):
+        if not numpy:
+            raise ImportError('NumPy is required for the numpy filter engine')
+    
+    def filtered_declarations(self, filters, declarations):
+        return numpy_filtered_declarations(filters, declarations)
 
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
-        sym_params = {}
-        for prop,attr in property_map.items():
-            sym_params[attr] = values.has_key(prop) and values[prop].value or None
-        
-        symbolizer = output.RasterSymbolizer(**sym_params)
+class DifferentialFilterEngine(FilterEngine):
+    """ Engine that runs two other engines side by side, and raises an
+        exception at the first difference between their results.
+    """
+    name = 'differential'
+    
+    def __init__(self, engine=None, other=None):
+        self.engine = engine or NumpyFilterEngine()
+        self.other = other or FilterEngine()
+    
+    def compare(self, step, result, other_result, key):
+        """ Raise an exception if two results of a step differ, by key.
+        """
+        if map(key, result) != map(key, other_result):
+            raise Exception('Filter engines %s and %s disagree on %s' % (self.engine.name, self.other.name, step))
+    
+        return result
+    
+    def filter_combinations(self, tests):
+        return self.compare('filter combinations', self.engine.filter_combinations(tests),
+                            self.other.filter_combinations(tests), repr)
+    
+    def filtered_declarations(self, filters, declarations):
+        def key((filter, rule)):
+            return repr(filter), sorted([(name, repr(value)) for (name, value) in rule.items()])
+    
+        return self.compare('filtered declarations', self.engine.filtered_declarations(filters, declarations),
+                            self.other.filtered_declarations(filters, declarations), key)
 
-        rules.append(make_rule(filter, symbolizer))
+# filter engines by name, for CompileContext
+FILTER_ENGINES = dict([(engine.name, engine) for engine in (FilterEngine, NumpyFilterEngine, DifferentialFilterEngine)])
 
-    if not rules:
-        # No raster-* rules were created, but we're here so we must need a symbolizer.
-        rules.append(make_rule(Filter(), output.RasterSymbolizer()))
+def test_matches_value(test, value):
+    """ Return False if an attribute value certainly fails a test, True otherwise.
     
-    return rules
+        Values that are missing or can't be compared to the test are assumed
+        to pass, because we can't know what Mapnik will make of them.
+    """
+    if value is None:
+        return True
+    
+    if type(test.value) in (int, float) and isinstance(value, basestring):
+        try:
+            value = float(value)
+        except ValueError:
+            return True
+    
+    elif isinstance(test.value, basestring) and not isinstance(value, basestring):
+        return True
+    
+    ops = {'=': operator.eq, '!=': operator.ne, '<': lt, '<=': le, '>=': ge, '>': gt}
+    
+    return ops[test.op](value, test.value)
+
+def filter_has_features(filter, feature_values):
+    """ Given a Filter and a (path, property names, value tuples) feature_values
+        tuple from shapefile_feature_values(), return False if no feature could
+        match the filter.
+    """
+    path, properties, values = feature_values
+    
+    tests = [(properties.index(test.property), test) for test in filter.tests
+             if test.property in properties and not test.isMapScaled()]
+    
+    if not tests:
+        return True
+    
+    for value in values:
+        if False not in [test_matches_value(test, value[index]) for (index, test) in tests]:
+            return True
+    
+    return False
+
+def shapefile_feature_values(shp_path, declarations, encoding='utf-8'):
+    """ Given a local shapefile path and the declarations applicable to its
+        layer, return a (path, property names, value tuples) feature_values
+        tuple with each combination of tested attributes found in the data.
+        
+        Return None if there's nothing to test or no .dbf file to read.
+    """
+    properties = set()
+    
+    for dec in declarations:
+        for test in dec.selector.allTests():
+            if not test.isMapScaled():
+                properties.add(test.property)
+    
+    if not properties:
+        return None
+    
+    properties = tuple(sorted(properties))
+    dbf_path = posixpath.splitext(shp_path)[0] + '.dbf'
+    values = set()
+    
+    try:
+        for record in dbf.read_records(un_posix(dbf_path), properties, encoding):
+            values.add(tuple([record.get(property, None) for property in properties]))
+
+    except IOError, e:
+        msg('Not reading attributes from %s: %s' % (dbf_path, e))
+        return None
+    
+    msg('Found %d combinations of %s in %s' % (len(values), ', '.join(properties), dbf_path))
+    
+    return dbf_path, properties, values
+
+def cascaded_declarations(declarations):
+    """ Given a list of declarations in cascade order, return a shorter list
+        that results in the same rules from filtered_property_declarations().
+    
+        A declaration is dropped when a later one for the same property has
+        the same tests, or when the previous one for the same property has
+        the same value and tests that are a subset of its own. Tests that are
+        only found in dropped declarations no longer multiply filters.
+    """
+    def tests_key(dec):
+        return frozenset([unicode(test) for test in dec.selector.allTests()])
+    
+    def value_key(dec):
+        return dec.value.value.__class__, repr(dec.value.value)
+    
+    # later declarations shadow earlier ones, except for display: none
+    shadowed, seen = set(), set()
+    
+    for index in reversed(range(len(declarations))):
+        dec = declarations[index]
+        key = dec.property.name, tests_key(dec)
+        
+        if key in seen and (dec.property.name, dec.value.value) != ('display', 'none'):
+            shadowed.add(index)
+        
+        seen.add(key)
+    
+    # the previous declaration for each property, by name
+    previous = {}
+    cascaded = []
+    
+    for (index, dec) in enumerate(declarations):
+        if index in shadowed:
+            continue
+        
+        name = dec.property.name
+        
+        if name != 'display' and name in previous:
+            # the previous declaration already applies everywhere this one does
+            if value_key(previous[name]) == value_key(dec) and tests_key(previous[name]) <= tests_key(dec):
+                continue
+        
+        cascaded.append(dec)
+        previous[name] = dec
+    
+    return cascaded
+
+def filtered_property_declarations(declarations, property_names, context=None):
+    """
+    """
+    context = context or CompileContext()
+    property_names += ['display']
 
-def get_line_rules(declarations):
+    # just the ones we care about here
+    declarations = [dec for dec in declarations if dec.property.name in property_names]
+    
+    if context.optimize_cascade:
+        declarations = cascaded_declarations(declarations)
+    
+    selectors = [dec.selector for dec in declarations]
+    
+    filters = ranked_filter_combinations(selectors_tests(selectors), context)
+    
+    if context.feature_values:
+        kept = [filter for filter in filters if filter_has_features(filter, context.feature_values)]
+        context.count('filters without features', len(filters) - len(kept))
+        filters = kept
+    
+    return context.filter_engine.filtered_declarations(filters, declarations)
+
+def get_polygon_rules(declarations, context=None):
+    """ Given a Map element, a Layer element, and a list of declarations,
+        create a new Style element with a PolygonSymbolizer, add it to Map
+        and refer to it in Layer.
+    """
+    property_map = {'polygon-fill': 'fill', 'polygon-opacity': 'fill-opacity',
+                    'polygon-gamma': 'gamma',
+                    'polygon-meta-output': 'meta-output', 'polygon-meta-writer': 'meta-writer'}
+
+    property_names = property_map.keys()
+    
+    # a place to put rules
+    rules = []
+    
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
+        color = values.has_key('polygon-fill') and values['polygon-fill'].value
+        opacity = values['polygon-opacity'].value if values.has_key('polygon-opacity') else None
+        gamma = values.has_key('polygon-gamma') and values['polygon-gamma'].value or None
+        symbolizer = color and output.PolygonSymbolizer(color, opacity, gamma)
+        
+        if symbolizer:
+            rules.append((filter, make_rule(filter, symbolizer)))
+    
+    return make_rules(rules, context)
+
+def get_raster_rules(declarations, context=None):
+    """ Given a Map element, a Layer element, and a list of declarations,
+        create a new Style element with a RasterSymbolizer, add it to Map
+        and refer to it in Layer.
+        
+        The RasterSymbolizer will always created, even if there are
+        no applicable declarations.
+    """
+    property_map = {'raster-opacity': 'opacity',
+                    'raster-mode': 'mode',
+                    'raster-scaling': 'scaling'
+                    }
+
+    property_names = property_map.keys()
+
+    # a place to put rules
+    rules = []
+
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
+        sym_params = {}
+        for prop,attr in property_map.items():
+            sym_params[attr] = values[prop].value if values.has_key(prop) else None
+        
+        symbolizer = output.RasterSymbolizer(**sym_params)
+
+        rules.append((filter, make_rule(filter, symbolizer)))
+
+    if not rules:
+        # No raster-* rules were created, but we're here so we must need a symbolizer.
+        rules.append((Filter(), make_rule(Filter(), output.RasterSymbolizer())))
+    
+    return make_rules(rules, context)
+
+def get_line_rules(declarations, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         This function is wise to line-<foo>, inline-<foo>, and outline-<foo> properties,
@@ -921,12 +1765,12 @@ def get_line_rules(declarations):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
     
         width = values.has_key('line-width') and values['line-width'].value
         color = values.has_key('line-color') and values['line-color'].value
 
-        opacity = values.has_key('line-opacity') and values['line-opacity'].value or None
+        opacity = values['line-opacity'].value if values.has_key('line-opacity') else None
         join = values.has_key('line-join') and values['line-join'].value or None
         cap = values.has_key('line-cap') and values['line-cap'].value or None
         dashes = values.has_key('line-dasharray') and values['line-dasharray'].value or None
@@ -936,7 +1780,7 @@ def get_line_rules(declarations):
         width = values.has_key('inline-width') and values['inline-width'].value
         color = values.has_key('inline-color') and values['inline-color'].value
 
-        opacity = values.has_key('inline-opacity') and values['inline-opacity'].value or None
+        opacity = values['inline-opacity'].value if values.has_key('inline-opacity') else None
         join = values.has_key('inline-join') and values['inline-join'].value or None
         cap = values.has_key('inline-cap') and values['inline-cap'].value or None
         dashes = values.has_key('inline-dasharray') and values['inline-dasharray'].value or None
@@ -948,7 +1792,7 @@ def get_line_rules(declarations):
             and values['line-width'].value + values['outline-width'].value * 2
         color = values.has_key('outline-color') and values['outline-color'].value
 
-        opacity = values.has_key('outline-opacity') and values['outline-opacity'].value or None
+        opacity = values['outline-opacity'].value if values.has_key('outline-opacity') else None
         join = values.has_key('outline-join') and values['outline-join'].value or None
         cap = values.has_key('outline-cap') and values['outline-cap'].value or None
         dashes = values.has_key('outline-dasharray') and values['outline-dasharray'].value or None
@@ -956,11 +1800,11 @@ def get_line_rules(declarations):
         outline_symbolizer = color and width and output.LineSymbolizer(color, width, opacity, join, cap, dashes) or False
         
         if outline_symbolizer or line_symbolizer or inline_symbolizer:
-            rules.append(make_rule(filter, outline_symbolizer, line_symbolizer, inline_symbolizer))
+            rules.append((filter, make_rule(filter, outline_symbolizer, line_symbolizer, inline_symbolizer)))
 
-    return rules
+    return make_rules(rules, context)
 
-def get_text_rule_groups(declarations):
+def get_text_rule_groups(declarations, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
     """
     property_map = {'text-anchor-dx': 'anchor_dx', # does nothing
@@ -1017,7 +1861,7 @@ def get_text_rule_groups(declarations):
         # a place to put rules
         rules = []
         
-        for (filter, values) in filtered_property_declarations(name_declarations, property_names):
+        for (filter, values) in filtered_property_declarations(name_declarations, property_names, context):
             
             face_name = values.has_key('text-face-name') and values['text-face-name'].value or None
             fontset = values.has_key('text-fontset') and values['text-fontset'].value or None
@@ -1055,17 +1899,661 @@ def get_text_rule_groups(declarations):
                                               anchor_dx, anchor_dy,horizontal_alignment, \
                                               vertical_alignment, justify_alignment)
             
-                rules.append(make_rule(filter, symbolizer))
+                rules.append((filter, make_rule(filter, symbolizer)))
         
-        groups.append((text_name, rules))
+        groups.append((text_name, make_rules(rules, context)))
     
     return dict(groups)
 
-def locally_cache_remote_file(href, dir):
+# bytes read at a time when streaming a download to a file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# interrupted downloads at least this large are kept to be resumed later
+RESUME_MIN_SIZE = 1024 * 1024
+
+# server errors that are worth asking again about, after a pause
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# seconds that a 404 or unreachable server is remembered in the cache
+NEGATIVE_CACHE_AGE = 300
+
+# redirects followed from one remote resource before giving up
+MAX_REDIRECTS = 5
+
+# seconds that a ConnectionPool doesn't try an unreachable host again
+UNREACHABLE_AGE = 30
+
+class ConnectionPool:
+    """ Keep-alive HTTP and HTTPS connections, shared by everything fetched
+        from the same scheme, host and port during a compile.
+    
+        At most max_per_host connections to one host are open at once, and
+        idle connections unused for idle_timeout seconds are closed rather
+        than reused. Safe to use from several threads.
+        
+        Failed connections and server errors are retried up to retries
+        times, waiting a jittered backoff seconds that doubles each time.
+        A host that still can't be reached isn't tried again for
+        UNREACHABLE_AGE seconds. No request is made after the optional
+        deadline, a time() value.
+    """
+    def __init__(self, max_per_host=4, idle_timeout=30, timeout=5, retries=2, backoff=0.5, deadline=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        
+        # number of new connections made, for the curious
+        self.opened = 0
+        
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        
+        # socket errors and their times from hosts that couldn't be reached, by scheme and host
+        self.unreachable = {}
+    
+    def __getstate__(self):
+        """ Only settings survive pickling, connections stay behind.
+        """
+        return self.max_per_host, self.idle_timeout, self.timeout, \
+               self.retries, self.backoff, self.deadline
+    
+    def __setstate__(self, state):
+        self.__init__(*state)
+    
+    def slot(self, key):
+        self.lock.acquire()
+        
+        try:
+            if key not in self.slots:
+                self.slots[key] = threading.Semaphore(self.max_per_host)
+            
+            return self.slots[key]
+        finally:
+            self.lock.release()
+    
+    def time_left(self):
+        """ Return the socket timeout for a request made now, which can't
+            run past the deadline.
+        """
+        if self.deadline is None:
+            return self.timeout
+        
+        left = self.deadline - time()
+        
+        if left <= 0:
+            raise IOError('Ran out of time for fetching remote resources')
+        
+        return min(self.timeout, left)
+    
+    def cut_short(self, conn, error):
+        """ Return true if an error is a connection timing out early
+            only because the deadline was near.
+        """
+        return isinstance(error, socket.timeout) and conn.timeout < self.timeout
+    
+    def retry_delay(self, attempt):
+        """ Return seconds to wait before retrying a failed attempt,
+            or None if it shouldn't be retried.
+        """
+        if attempt >= self.retries:
+            return None
+        
+        delay = self.backoff * 2**attempt * random.uniform(.5, 1.5)
+        
+        if self.deadline is not None and time() + delay >= self.deadline:
+            return None
+        
+        return delay
+    
+    def connect(self, scheme, host):
+        """ Return a (connection, reused) tuple for a scheme and host,
+            waiting if there are already max_per_host connections to it.
+        """
+        if (scheme, host) in self.unreachable:
+            error, failed_at = self.unreachable[(scheme, host)]
+            
+            if time() - failed_at < UNREACHABLE_AGE:
+                raise error
+        
+        self.slot((scheme, host)).acquire()
+        
+        try:
+            timeout = self.time_left()
+        except:
+            self.slot((scheme, host)).release()
+            raise
+        
+        self.lock.acquire()
+        
+        try:
+            idle = self.idle.get((scheme, host), [])
+            
+            while idle:
+                conn, released = idle.pop()
+                
+                if time() - released < self.idle_timeout:
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    conn.timeout = timeout
+                    return conn, True
+                
+                conn.close()
+            
+            self.opened += 1
+        finally:
+            self.lock.release()
+        
+        if scheme == 'https':
+            return HTTPSConnection(host, timeout=timeout), False
+        else:
+            return HTTPConnection(host, timeout=timeout), False
+    
+    def release(self, scheme, host, conn, reusable):
+        """ Return a connection from connect() to the pool, or close it.
+        """
+        self.lock.acquire()
+        
+        try:
+            if reusable:
+                self.idle.setdefault((scheme, host), []).append((conn, time()))
+            else:
+                conn.close()
+        finally:
+            self.lock.release()
+        
+        self.slot((scheme, host)).release()
+    
+    def request(self, scheme, host, path, headers={}, open_file=None):
+        """ GET a path from a host, and return the response with its body.
+        
+            If open_file is given, it's called with the response and can
+            return a file. The body is then streamed to that file in chunks
+            and the file closed, and the returned body is empty.
+            
+            A reused connection that the server has since closed is
+            replaced with a new one, which doesn't count as a retry.
+            
+            Running out of time because of the deadline raises IOError,
+            rather than the socket.timeout a slow host would.
+        """
+        attempt = 0
+        
+        while True:
+            conn, reused = self.connect(scheme, host)
+            
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            
+            except (socket.error, httplib.HTTPException), e:
+                self.release(scheme, host, conn, False)
+                
+                if self.cut_short(conn, e):
+                    raise IOError('Ran out of time for fetching %s://%s%s' % (scheme, host, path))
+                
+                if reused:
+                    continue
+                
+                delay = self.retry_delay(attempt)
+                
+                if delay is not None:
+                    sleep(delay)
+                    attempt += 1
+                    continue
+                
+                if isinstance(e, socket.error):
+                    # don't keep waiting on a dead host
+                    self.unreachable[(scheme, host)] = e, time()
+                
+                raise
+            
+            if resp.status in RETRY_STATUSES:
+                delay = self.retry_delay(attempt)
+                
+                if delay is not None:
+                    resp.read()
+                    self.release(scheme, host, conn, not resp.will_close)
+                    sleep(delay)
+                    attempt += 1
+                    continue
+            
+            break
+        
+        try:
+            file = open_file and open_file(resp)
+            
+            if file is None:
+                body = resp.read()
+            
+            else:
+                body = ''
+                
+                try:
+                    for chunk in iter(lambda: resp.read(DOWNLOAD_CHUNK_SIZE), ''):
+                        file.write(chunk)
+                finally:
+                    file.close()
+        
+        except:
+            self.release(scheme, host, conn, False)
+            
+            if self.cut_short(conn, sys.exc_info()[1]):
+                raise IOError('Ran out of time for fetching %s://%s%s' % (scheme, host, path))
+            
+            raise
+        
+        self.release(scheme, host, conn, not resp.will_close)
+        return resp, body
+    
+    def close(self):
+        """ Close all idle connections.
+        """
+        self.lock.acquire()
+        
+        try:
+            for idle in self.idle.values():
+                for (conn, released) in idle:
+                    conn.close()
+            
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+def lock_cache_entry(path, blocking=True, shared=False):
+    """ Take an exclusive advisory lock on a path in the cache directory, by
+        way of a .lock file next to it, and return the open lock file.
+        
+        Other processes and threads wait for the lock to be released with
+        unlock_cache_entry(). If blocking is False and the lock is already
+        held, return None instead of waiting. If shared is True, others can
+        take shared locks on the same path at the same time.
+        
+        Eviction removes the lock files of entries it removes, so a lock
+        file that's gone by the time it's locked is tried again.
+    """
+    while True:
+        lock = open(un_posix(path + '.lock'), 'a')
+        
+        if not fcntl:
+            return lock
+        
+        mode = shared and fcntl.LOCK_SH or fcntl.LOCK_EX
+        
+        try:
+            fcntl.flock(lock.fileno(), mode | (not blocking and fcntl.LOCK_NB or 0))
+        except IOError:
+            lock.close()
+            return None
+        
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(un_posix(path + '.lock')).st_ino:
+                return lock
+        except OSError:
+            # removed just now
+            pass
+        
+        unlock_cache_entry(lock)
+
+def unlock_cache_entry(lock):
+    if fcntl:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    
+    lock.close()
+
+def hold_cache_entry(path):
+    """ Take a shared lock on the cache entry of a path for the compile()
+        running in this thread, held until it's done so that no one evicts
+        the entry. Outside of compile(), do nothing.
+        
+        It's a separate .use.lock file, so that other compiles aren't kept
+        from updating the entry under its own lock in the meantime.
+    """
+    context = getattr(contexts, 'current', None)
+    
+    if context is None or path in context.cache_locks:
+        return
+    
+    context.cache_locks[path] = lock_cache_entry(path + '.use', shared=True)
+
+def release_cache_entries(context):
+    """ Release the shared locks held on cache entries by a compile().
+    """
+    for lock in context.cache_locks.values():
+        if lock is not None:
+            # None for locks held by the parent of a worker process
+            unlock_cache_entry(lock)
+    
+    context.cache_locks = {}
+
+def write_file_atomically(path, content):
+    """ Write content to a file by way of a temporary file in the same
+        directory, so that no one ever reads it partially written.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=un_posix(posixpath.dirname(path)), prefix='cascadenik-')
+    os.write(handle, content)
+    os.close(handle)
+    os.rename(temp_path, un_posix(path))
+
+def read_cache_meta(local_path):
+    """ Return the dictionary of cache metadata saved alongside a locally
+        cached remote file by locally_cache_remote_file(), or None.
+    """
+    try:
+        file = open(un_posix(local_path + '.meta'), 'rb')
+        meta = pickle.load(file)
+        file.close()
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    
+    return meta
+
+def write_cache_meta(local_path, meta):
+    write_file_atomically(local_path + '.meta', pickle.dumps(meta, pickle.HIGHEST_PROTOCOL))
+
+def response_max_age(resp):
+    """ Return the number of seconds a response may be used without asking
+        the server again according to its Cache-Control header, or None.
+    """
+    max_age = None
+    
+    for directive in resp.getheader('cache-control', '').lower().split(','):
+        directive = directive.strip()
+        
+        if directive in ('no-cache', 'no-store'):
+            return 0
+        
+        elif directive.startswith('max-age='):
+            try:
+                max_age = int(directive[8:])
+            except ValueError:
+                pass
+    
+    return max_age
+
+def write_failure_meta(local_path, meta, reason):
+    """ Remember in the cache metadata of a remote file that it couldn't be
+        fetched just now, so it's not asked for again for NEGATIVE_CACHE_AGE.
+    """
+    meta = dict(meta or {})
+    meta.update({'failed': reason, 'failed-at': time()})
+    write_cache_meta(local_path, meta)
+
+def is_failed_cache_meta(meta):
+    """ Return true if cache metadata says a file recently failed to fetch.
+    """
+    if meta is None or meta.get('failed') is None:
+        return False
+    
+    return time() - meta['failed-at'] < NEGATIVE_CACHE_AGE
+
+def is_fresh_cache_meta(meta):
+    """ Return true if cache metadata says a file is still fresh.
+    """
+    if meta is None or meta.get('max-age') is None:
+        return False
+    
+    return time() - meta['fetched'] < meta['max-age']
+
+def read_manifest(cache_dir):
+    """ Return the manifest of remote files in a cache directory, a dictionary
+        of URLs and cached file paths relative to the directory.
+    
+        The manifest is written by compiles that fetch remote files, and
+        read by offline compiles that can't.
+    """
+    try:
+        file = open(un_posix(posixpath.join(cache_dir, 'manifest.pickle')), 'rb')
+        manifest = pickle.load(file)
+        file.close()
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return {}
+    
+    return manifest
+
+def update_manifest(cache_dir, remote_files):
+    """ Add a dictionary of URLs and local paths from locally_cache_remote_file()
+        to the manifest in a cache directory.
+    """
+    lock = lock_cache_entry(posixpath.join(cache_dir, 'manifest.pickle'))
+    
+    try:
+        manifest = read_manifest(cache_dir)
+        
+        for (href, local_path) in remote_files.items():
+            manifest[href] = posixpath.relpath(local_path, cache_dir)
+        
+        write_file_atomically(posixpath.join(cache_dir, 'manifest.pickle'),
+                              pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL))
+    finally:
+        unlock_cache_entry(lock)
+
+def cache_entry_name(path):
+    """ Return the name of the cache entry a file belongs to, which is its
+        path relative to the cache directory without extensions.
+        
+        A remote file, its .meta and .part files, and an image converted
+        from it all belong to one entry, as do the parts of an unzipped
+        shapefile.
+    """
+    return sub(r'(\.\w+)+$', '', path)
+
+def read_cache_index(cache_dir):
+    """ Return a dictionary of last access times for cache entries, by name.
+    """
+    try:
+        file = open(un_posix(posixpath.join(cache_dir, 'index.pickle')), 'rb')
+        index = pickle.load(file)
+        file.close()
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return {}
+    
+    return index
+
+def write_cache_index(cache_dir, index):
+    write_file_atomically(posixpath.join(cache_dir, 'index.pickle'),
+                          pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+
+def record_cache_access(cache_dir, paths):
+    """ Note in the cache index that the entries of some files were just used.
+    """
+    lock = lock_cache_entry(posixpath.join(cache_dir, 'index.pickle'))
+    
+    try:
+        index, now = read_cache_index(cache_dir), time()
+        
+        for path in paths:
+            index[cache_entry_name(posixpath.relpath(path, cache_dir))] = now
+        
+        write_cache_index(cache_dir, index)
+    finally:
+        unlock_cache_entry(lock)
+
+def evict_cache_entries(cache_dir, budget, keep_paths=()):
+    """ Remove least-recently used entries from a cache directory until its
+        files add up to no more than budget bytes, and return their names.
+        
+        Entries of the given paths are kept regardless, as are the manifest,
+        the index and temporary files that are still being written. Entries
+        missing from the index are judged by their newest modification time,
+        and entries locked by someone else are skipped. Lock files are only
+        removed along with the rest of their entry.
+    """
+    lock = lock_cache_entry(posixpath.join(cache_dir, 'index.pickle'))
+    
+    try:
+        return evict_unlocked_cache_entries(cache_dir, budget, keep_paths)
+    finally:
+        unlock_cache_entry(lock)
+
+def evict_unlocked_cache_entries(cache_dir, budget, keep_paths):
+    """ Do the work of evict_cache_entries(), with the index already locked.
+    """
+    index = read_cache_index(cache_dir)
+    keep = set([cache_entry_name(posixpath.relpath(path, cache_dir)) for path in keep_paths])
+    entries, total = {}, 0
+    
+    for (dirpath, dirnames, filenames) in os.walk(un_posix(cache_dir)):
+        for filename in filenames:
+            path = systempath.join(dirpath, filename)
+            name = systempath.relpath(path, un_posix(cache_dir)).replace(systempath.sep, '/')
+            
+            if name in ('manifest.pickle', 'index.pickle') or filename.startswith('cascadenik-'):
+                continue
+            
+            if filename.endswith('.lock'):
+                # removed with their entry, while they're locked
+                entries.setdefault(cache_entry_name(name), [0, 0, [], []])[3].append(path[:-5])
+                continue
+            
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # someone else just removed it
+                continue
+            
+            entry = entries.setdefault(cache_entry_name(name), [0, 0, [], []])
+            entry[0] += stat.st_size
+            entry[1] = max(entry[1], stat.st_mtime)
+            entry[2].append(path)
+            total += stat.st_size
+    
+    evictable = [(index.get(name, mtime), name, size, paths, locked_paths)
+                 for (name, (size, mtime, paths, locked_paths)) in entries.items()
+                 if name not in keep and paths]
+    
+    evicted = []
+    
+    for (used, name, size, paths, locked_paths) in sorted(evictable):
+        if total <= budget:
+            break
+        
+        locks = [lock_cache_entry(path, False) for path in locked_paths]
+        
+        if None not in locks:
+            for path in paths + [path + '.lock' for path in locked_paths]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        
+        for lock in locks:
+            if lock is not None:
+                unlock_cache_entry(lock)
+        
+        if None in locks:
+            # someone else is using it
+            continue
+        
+        index.pop(name, None)
+        evicted.append(name)
+        total -= size
+    
+    if evicted:
+        msg('Evicted %d least-recently used entries from %s' % (len(evicted), cache_dir))
+        write_cache_index(cache_dir, index)
+    
+    return evicted
+
+def manifest_local_path(href, cache_dir):
+    """ Return the path of a remote file according to the cache manifest of
+        the current context, or None if it's missing.
+    """
+    context = current_context()
+    
+    if context.manifest is None:
+        context.manifest = read_manifest(cache_dir)
+    
+    if href not in context.manifest:
+        return None
+    
+    local_path = posixpath.join(cache_dir, context.manifest[href])
+    
+    if not posixpath.exists(local_path):
+        return None
+    
+    return local_path
+
+def response_length(resp):
+    """ Return the complete length in bytes of a 200 or 206 response's
+        content, or None if the server didn't say.
+    """
+    if resp.status == 206:
+        length = resp.getheader('content-range', '').split('/')[-1]
+    else:
+        length = resp.getheader('content-length', '')
+    
+    try:
+        return int(length)
+    except ValueError:
+        return None
+
+def remove_partial_download(local_path, keep_resumable=False):
+    """ Remove the .part file of a download and its .meta file, optionally
+        keeping ones large enough to be worth resuming that can be resumed.
+    """
+    part_path = local_path + '.part'
+    
+    if keep_resumable and posixpath.exists(part_path) and read_cache_meta(part_path):
+        if os.stat(un_posix(part_path)).st_size >= RESUME_MIN_SIZE:
+            return
+    
+    for path in (part_path, part_path + '.meta'):
+        if posixpath.exists(path):
+            os.remove(un_posix(path))
+
+def locally_cache_remote_file(href, dir, redirects=()):
     """ Locally cache a remote resource using a predictable file name
         and awareness of modification date. Assume that files are "normal"
         which is to say they have filenames with extensions.
+        
+        Each file has a .meta file alongside with its ETag, Last-Modified,
+        fetch time and max-age. Files still within their max-age are used
+        without asking the server, and others are revalidated. Redirects
+        are remembered in the .meta file of the original URL, pointing to
+        the cached file for the new location.
+        
+        Downloads are streamed to a .part file that's renamed into place
+        once its length is checked. Large interrupted downloads are resumed
+        with a Range request.
+        
+        Each file is locked while it's fetched, so that concurrent compiles
+        sharing a cache directory download it just once, and held until the
+        compile is done, so that none of them evicts it.
+        
+        Files whose server couldn't be reached, or answered with an error,
+        are served from an older copy if there is one, and otherwise fail.
+        Either way they're not asked for again for NEGATIVE_CACHE_AGE
+        seconds. Missing files are removed from the cache and fail the same
+        way. Running out of fetch_budget isn't remembered as a failure.
+        
+        Redirects are followed with the original file unlocked, up to
+        MAX_REDIRECTS of them. Redirects is the list of URLs that led here.
     """
+    context = current_context()
+    remote_files = context.remote_files
+    
+    if href in remote_files:
+        # already fetched during this compile, e.g. by prefetch()
+        return remote_files[href]
+    
+    if href in context.remote_failures:
+        # ...or failed to be
+        raise context.remote_failures[href]
+    
+    if context.offline:
+        local_path = manifest_local_path(href, dir)
+        
+        if local_path is None:
+            raise Exception("Remote resource %s is not in the offline cache manifest" % href)
+        
+        hold_cache_entry(local_path)
+        remote_files[href] = local_path
+        return local_path
+    
     scheme, host, remote_path, params, query, fragment = urlparse(href)
     
     assert scheme in ('http','https'), 'Scheme must be either http or https, not "%s" (for %s)' % (scheme,href)
@@ -1075,46 +2563,173 @@ def locally_cache_remote_file(href, dir):
     hash = md5(href).hexdigest()[:8]
     
     local_path = '%(dir)s/%(host)s-%(hash)s-%(head)s%(ext)s' % locals()
+    lock = lock_cache_entry(local_path)
+    
+    try:
+        location = cache_remote_file(href, local_path, dir)
+        hold_cache_entry(local_path)
+    finally:
+        unlock_cache_entry(lock)
+    
+    if location is not None:
+        redirects = redirects + (href, )
+        
+        if location in redirects:
+            raise Exception("Redirect loop from %s: %s" % (redirects[0], ' -> '.join(redirects + (location, ))))
+        
+        elif len(redirects) > MAX_REDIRECTS:
+            raise Exception("Too many redirects from %s" % redirects[0])
+        
+        local_path = locally_cache_remote_file(location, dir, redirects)
+    
+    remote_files[href] = local_path
+    return local_path
+
+def cache_remote_file(href, local_path, dir):
+    """ Fetch a remote resource to its local path in the cache directory for
+        locally_cache_remote_file(), with the path already locked. Return the
+        URL that a redirect points to, or None if the file is at the path.
+    """
+    scheme, host, remote_path, params, query, fragment = urlparse(href)
+    meta = read_cache_meta(local_path)
+    
+    if is_fresh_cache_meta(meta) and meta.get('location'):
+        msg('Following fresh redirect: %s' % meta['location'])
+        return meta['location']
+    
+    elif is_fresh_cache_meta(meta) and posixpath.exists(local_path):
+        msg('Found fresh local file: %s' % local_path)
+        return None
+    
+    elif is_failed_cache_meta(meta) and posixpath.exists(local_path):
+        msg('Found local file that recently failed to update: %s' % local_path)
+        return None
+    
+    elif is_failed_cache_meta(meta):
+        raise Exception("Failed to get remote resource %s recently: %s" % (href, meta['failed']))
 
+    part_path = local_path + '.part'
+    part_meta = read_cache_meta(part_path)
+    part_size = 0
+    
     headers = {}
-    if posixpath.exists(local_path):
+    if part_meta and posixpath.exists(part_path):
+        # resume an interrupted download, if it's unchanged on the server
+        part_size = os.stat(un_posix(part_path)).st_size
+        headers['Range'] = 'bytes=%d-' % part_size
+        headers['If-Range'] = part_meta.get('etag') or part_meta.get('last-modified')
+        msg('Resuming download after %d bytes: %s' % (part_size, part_path))
+    
+    elif posixpath.exists(local_path):
         msg('Found local file: %s' % local_path )
-        t = localtime(os.stat(local_path).st_mtime)
-        headers['If-Modified-Since'] = strftime('%a, %d %b %Y %H:%M:%S %Z', t)
+        
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        
+        if meta and meta.get('last-modified'):
+            headers['If-Modified-Since'] = meta['last-modified']
+        elif not meta:
+            headers['If-Modified-Since'] = formatdate(os.stat(local_path).st_mtime, usegmt=True)
     
-    if scheme == 'https':
-        conn = HTTPSConnection(host, timeout=5)
-    else:
-        conn = HTTPConnection(host, timeout=5)
-
     if query:
         remote_path += '?%s' % query
 
-    conn.request('GET', remote_path, headers=headers)
-    resp = conn.getresponse()
+    def open_part(resp):
+        """ Open the .part file to stream a successful response to.
+        """
+        if resp.status == 206 and resp.getheader('content-range', '').startswith('bytes %d-' % part_size):
+            msg('Resuming from remote: %s' % remote_path)
+            return open(un_posix(part_path), 'ab')
+        
+        elif resp.status == 206:
+            # not the range we asked for
+            remove_partial_download(local_path)
+        
+        elif resp.status in range(200, 210):
+            msg('Reading from remote: %s' % remote_path)
+            remove_partial_download(local_path)
+            
+            if resp.getheader('etag') or resp.getheader('last-modified'):
+                # enough to resume this download if it's interrupted
+                write_cache_meta(part_path, {'etag': resp.getheader('etag'),
+                                             'last-modified': resp.getheader('last-modified')})
+            
+            return open(un_posix(part_path), 'wb')
+    
+    try:
+        resp, body = current_context().connection_pool().request(scheme, host, remote_path, headers, open_part)
+    except socket.error, e:
+        remove_partial_download(local_path, True)
+        write_failure_meta(local_path, meta, str(e) or e.__class__.__name__)
         
-    if resp.status in range(200, 210):
+        if posixpath.exists(local_path):
+            msg('Failed to update local file, using it anyway: %s (%s)' % (local_path, e))
+            return None
+        
+        raise
+    except:
+        remove_partial_download(local_path, True)
+        raise
+    
+    fetched = time()
+        
+    if resp.status in range(200, 210) and posixpath.exists(part_path):
         # hurrah, it worked
-        f = open(un_posix(local_path), 'wb')
-        msg('Reading from remote: %s' % remote_path)
-        f.write(resp.read())
-        f.close()
+        length, size = response_length(resp), os.stat(un_posix(part_path)).st_size
+        
+        if length is not None and size != length:
+            remove_partial_download(local_path, True)
+            raise IOError('Incomplete download of %s: %d of %d bytes' % (href, size, length))
+        
+        os.rename(un_posix(part_path), un_posix(local_path))
+        remove_partial_download(local_path)
+        
+        meta = {'etag': resp.getheader('etag'), 'last-modified': resp.getheader('last-modified')}
 
-    elif resp.status in (301, 302, 303) and resp.getheader('location', False):
-        # follow a redirect, totally untested.
+    elif resp.status == 416 and part_size:
+        # the partial download can't be resumed, so start over
+        remove_partial_download(local_path)
+        return cache_remote_file(href, local_path, dir)
+
+    elif resp.status in (301, 302, 303, 307, 308) and resp.getheader('location', False):
+        # remember where the redirect points, rather than copying the file
         redirected_href = urljoin(href, resp.getheader('location'))
-        redirected_path = locally_cache_remote_file(redirected_href, dir)
-        os.rename(redirected_path, local_path)
+        write_cache_meta(local_path, {'location': redirected_href, 'fetched': fetched,
+                                      'max-age': response_max_age(resp)})
+
+        return redirected_href
     
-    elif resp.status == 304:
+    elif resp.status == 304 and posixpath.exists(local_path):
         # hurrah, it's cached
         msg('Reading directly from local cache')
-        pass
+        meta = meta or {}
+        meta.pop('failed', None)
+        meta.pop('failed-at', None)
+        
+        if resp.getheader('etag'):
+            meta['etag'] = resp.getheader('etag')
 
+    elif resp.status in (404, 410):
+        # it's gone, so the cached copy goes too
+        if posixpath.exists(local_path):
+            msg('Removing local file of missing remote resource: %s' % local_path)
+            os.remove(un_posix(local_path))
+        
+        write_failure_meta(local_path, None, resp.status)
+        raise Exception("Failed to get remote resource %s: %s" % (href, resp.status))
+    
+    elif posixpath.exists(local_path):
+        write_failure_meta(local_path, meta, resp.status)
+        msg('Failed to update local file, using it anyway: %s (%s)' % (local_path, resp.status))
+        return None
+    
     else:
         raise Exception("Failed to get remote resource %s: %s" % (href, resp.status))
     
-    return local_path
+    meta.update({'fetched': fetched, 'max-age': response_max_age(resp)})
+    write_cache_meta(local_path, meta)
+    
+    return None
 
 def post_process_symbolizer_image_file(file_href, dirs):
     """ Given an image file href and a set of directories, modify the image file
@@ -1158,13 +2773,17 @@ def post_process_symbolizer_image_file(file_href, dirs):
     dest_file = un_posix('%s%s' % (image_name, output_ext))
     
     if not posixpath.exists(dest_file):
-        img.save(dest_file,'PNG')
+        # save to a temporary file first so no one reads a partial image
+        handle, temp_file = tempfile.mkstemp(dir=systempath.dirname(dest_file), prefix='cascadenik-', suffix='.png')
+        os.close(handle)
+        img.save(temp_file, 'PNG')
+        os.rename(temp_file, dest_file)
 
     msg('Destination file: %s' % dest_file)
 
     return dest_file, output_ext[1:], img.size[0], img.size[1]
 
-def get_shield_rule_groups(declarations, dirs):
+def get_shield_rule_groups(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1204,7 +2823,7 @@ def get_shield_rule_groups(declarations, dirs):
         # a place to put rules
         rules = []
         
-        for (filter, values) in filtered_property_declarations(name_declarations, property_names):
+        for (filter, values) in filtered_property_declarations(name_declarations, property_names, context):
         
             face_name = values.has_key('shield-face-name') and values['shield-face-name'].value or None
             fontset = values.has_key('shield-fontset') and values['shield-fontset'].value or None
@@ -1234,13 +2853,13 @@ def get_shield_rule_groups(declarations, dirs):
                                             line_spacing, label_spacing, text_dx=text_dx, text_dy=text_dy,
                                             fontset=fontset)
             
-                rules.append(make_rule(filter, symbolizer))
+                rules.append((filter, make_rule(filter, symbolizer)))
         
-        groups.append((text_name, rules))
+        groups.append((text_name, make_rules(rules, context)))
     
     return dict(groups)
 
-def get_point_rules(declarations, dirs):
+def get_point_rules(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1255,7 +2874,7 @@ def get_point_rules(declarations, dirs):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
         point_file, point_type, point_width, point_height \
             = values.has_key('point-file') \
             and post_process_symbolizer_image_file(str(values['point-file'].value), dirs) \
@@ -1268,11 +2887,11 @@ def get_point_rules(declarations, dirs):
         symbolizer = point_file and output.PointSymbolizer(point_file, point_type, point_width, point_height, point_allow_overlap)
 
         if symbolizer:
-            rules.append(make_rule(filter, symbolizer))
+            rules.append((filter, make_rule(filter, symbolizer)))
     
-    return rules
+    return make_rules(rules, context)
 
-def get_polygon_pattern_rules(declarations, dirs):
+def get_polygon_pattern_rules(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1287,7 +2906,7 @@ def get_polygon_pattern_rules(declarations, dirs):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
     
         poly_pattern_file, poly_pattern_type, poly_pattern_width, poly_pattern_height \
             = values.has_key('polygon-pattern-file') \
@@ -1299,11 +2918,11 @@ def get_polygon_pattern_rules(declarations, dirs):
         symbolizer = poly_pattern_file and output.PolygonPatternSymbolizer(poly_pattern_file, poly_pattern_type, poly_pattern_width, poly_pattern_height)
         
         if symbolizer:
-            rules.append(make_rule(filter, symbolizer))
+            rules.append((filter, make_rule(filter, symbolizer)))
     
-    return rules
+    return make_rules(rules, context)
 
-def get_line_pattern_rules(declarations, dirs):
+def get_line_pattern_rules(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1318,7 +2937,7 @@ def get_line_pattern_rules(declarations, dirs):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
     
         line_pattern_file, line_pattern_type, line_pattern_width, line_pattern_height \
             = values.has_key('line-pattern-file') \
@@ -1330,9 +2949,9 @@ def get_line_pattern_rules(declarations, dirs):
         symbolizer = line_pattern_file and output.LinePatternSymbolizer(line_pattern_file, line_pattern_type, line_pattern_width, line_pattern_height)
         
         if symbolizer:
-            rules.append(make_rule(filter, symbolizer))
+            rules.append((filter, make_rule(filter, symbolizer)))
     
-    return rules
+    return make_rules(rules, context)
 
 def get_applicable_declarations(element, declarations):
     """ Given an XML element and a list of declarations, return the ones
@@ -1346,10 +2965,43 @@ def get_applicable_declarations(element, declarations):
             if dec.selector.matches(element_tag, element_id, element_classes)]
 
 def unzip_shapefile_into(zip_path, dir, host=None):
+    """ Unzip the parts of a zipped shapefile into a directory, and return
+        the path of its .shp file without the extension.
+        
+        The parts are one cache entry, locked under that path while they're
+        written and then held by the compile() running in this thread.
     """
+    zip_file = zipfile.ZipFile(un_posix(zip_path))
+    local = unzipped_shapefile_path(zip_path, zip_file, dir, host)
+    lock = lock_cache_entry(local)
+    
+    try:
+        unzip_locked_shapefile_into(zip_path, zip_file, dir, host)
+        hold_cache_entry(local)
+    finally:
+        unlock_cache_entry(lock)
+    
+    return local
+
+def unzipped_shapefile_path(zip_path, zip_file, dir, host):
+    """ Return the path an unzipped shapefile's parts share, without extensions.
+    """
+    hash = md5(zip_path).hexdigest()[:8]
+    host_prefix = host and ('%(host)s-' % locals()) or ''
+    
+    for info in zip_file.infolist():
+        head, ext = posixpath.splitext(posixpath.basename(info.filename))
+        head = sub(r'[^\w\-_]', '', head)
+        
+        if ext == '.shp':
+            return '%(dir)s/%(host_prefix)s%(hash)s-%(head)s' % locals()
+    
+    raise Exception('Zip file %(zip_path)s missing extension ".shp"' % locals())
+
+def unzip_locked_shapefile_into(zip_path, zip_file, dir, host):
+    """ Do the work of unzip_shapefile_into(), with the parts already locked.
     """
     hash = md5(zip_path).hexdigest()[:8]
-    zip_file = zipfile.ZipFile(un_posix(zip_path))
     zip_ctime = os.stat(un_posix(zip_path)).st_ctime
     
     infos = zip_file.infolist()
@@ -1371,17 +3023,13 @@ def unzip_shapefile_into(zip_path, dir, host=None):
                 file_name = '%(dir)s/%(host_prefix)s%(hash)s-%(head)s%(ext)s' % locals()
                 
                 if not systempath.exists(un_posix(file_name)) or os.stat(un_posix(file_name)).st_ctime < zip_ctime:
-                    file_ = open(un_posix(file_name), 'wb')
-                    file_.write(file_data)
-                    file_.close()
+                    write_file_atomically(file_name, file_data)
                 
                 if ext == '.shp':
-                    local = file_name[:-4]
+                    current_context().cache_paths.add(file_name)
                 
                 break
 
-    return local
-
 def localize_shapefile(shp_href, dirs):
     """ Given a shapefile href and a set of directories, modify the shapefile
         name so it's correct with respect to the output and cache directories.
@@ -1446,13 +3094,357 @@ def localize_file_datasource(file_href, dirs):
     else:
         return dirs.output_path(path)
     
-def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_styles=[], scale=1):
+def is_remote_href(href, dirs):
+    """ Return true if an href is fetched over http or https, relative to dirs.source.
+    """
+    scheme = urlparse(urljoin(dirs.source.rstrip('/')+'/', href))[0]
+    return scheme in ('http', 'https')
+
+def remote_source_hrefs(map_el, dirs, datasources_cfg, user_styles):
+    """ Given a Map element before its stylesheets and configs are read,
+        return a list of remote URLs for them.
+    """
+    hrefs = [elem.get('src') for elem in map_el.findall('Stylesheet') + map_el.findall('DataSourcesConfig')
+             if elem.get('src')] + list(user_styles)
+    
+    hrefs = [urljoin(dirs.source.rstrip('/')+'/', href) for href in hrefs]
+    
+    if datasources_cfg:
+        # DataSources joins this to dirs.source without the trailing slash
+        hrefs.append(urljoin(dirs.source, datasources_cfg))
+    
+    return [href for href in hrefs if is_remote_href(href, dirs)]
+
+def remote_file_hrefs(map_el, dirs, declarations):
+    """ Given a Map element with expanded datasources and a list of declarations,
+        return a list of remote URLs for datasource files and images.
+        
+        Only images in declarations that apply to the map or one of its
+        enabled layers are included, since no others can be used.
+    """
+    elems = map_el.findall('Datasource')
+    indexes = set(applicable_indexes(map_el, declarations))
+    
+    for layer_el in map_el.findall('Layer'):
+        if layer_el.get('status', None) in ('off', '0', 0):
+            continue
+    
+        if layer_el.find('Datasource') is not None:
+            elems.append(layer_el.find('Datasource'))
+        
+        indexes.update(applicable_indexes(layer_el, declarations))
+    
+    hrefs = [param.text for elem in elems for param in elem.findall('Parameter')
+             if param.get('name') == 'file' and param.text]
+    
+    hrefs += [declarations[index].value.value.address for index in sorted(indexes)
+              if declarations[index].value.value.__class__ is uri]
+    
+    hrefs = [urljoin(dirs.source.rstrip('/')+'/', href) for href in hrefs]
+    
+    return [href for href in hrefs if is_remote_href(href, dirs)]
+
+def require_offline_files(hrefs, cache_dir):
+    """ Raise an exception listing every one of the given remote URLs
+        that's missing from the cache manifest.
+    """
+    missing = sorted(set([href for href in hrefs if manifest_local_path(href, cache_dir) is None]))
+    
+    if missing:
+        raise Exception('Remote resources missing from the offline cache manifest in %s:\n  %s' % (cache_dir, '\n  '.join(missing)))
+
+def prefetch_worker(args):
+    """ Call a function with a tuple of context, function and arguments,
+        for prefetch(). Failures are kept in the context for the compile
+        itself to raise, rather than fetching again.
+    """
+    context, function, function_args = args
+    contexts.current = context
+    
+    try:
+        function(*function_args)
+    except Exception, e:
+        context.msg('Failed to prefetch %s: %s' % (function_args[0], e))
+        context.remote_failures[function_args[0]] = e
+
+def prefetch(function, hrefs, context, *args):
+    """ Call a fetching function on each unique href at once, on a pool of
+        context.fetch_threads threads, so that later calls are cache hits.
+    """
+    hrefs = sorted(set(hrefs))
+    
+    if not hrefs or not context.fetch_threads:
+        return
+    
+    context.msg('Prefetching %d remote resources in %d threads' % (len(hrefs), context.fetch_threads))
+    pool = multiprocessing.pool.ThreadPool(min(len(hrefs), context.fetch_threads))
+    
+    try:
+        pool.map(prefetch_worker, [(context, function, (href, ) + args) for href in hrefs])
+    finally:
+        pool.terminate()
+    
+    context.count('prefetched', len(hrefs))
+
+def is_invisible_symbolizer(symbolizer):
+    """ Return true if a symbolizer would draw nothing at all.
+    """
+    if getattr(symbolizer, 'opacity', None) == 0:
+        return True
+    
+    if symbolizer.__class__ is output.LineSymbolizer and symbolizer.width == 0:
+        return True
+    
+    if symbolizer.__class__ is output.TextSymbolizer and symbolizer.size == 0:
+        return True
+    
+    return False
+
+def is_covering_rule(earlier, rule):
+    """ Return true if the scale range of one output.Rule covers another's.
+    """
+    emin, emax = earlier.minscale and earlier.minscale.value, earlier.maxscale and earlier.maxscale.value
+    rmin, rmax = rule.minscale and rule.minscale.value, rule.maxscale and rule.maxscale.value
+    
+    if emin is not None and (rmin is None or rmin < emin):
+        return False
+    
+    if emax is not None and (rmax is None or rmax > emax):
+        return False
+    
+    return True
+
+def is_unreachable_rule(rule, earlier_rules):
+    """ Return true if an output.Rule can never be used because of earlier rules in the same style.
+    
+        Mapnik 2.0.0 and later stop at the first matching rule, so a rule is
+        shadowed by an earlier one with the same filter or no filter at all.
+        An ElseFilter is always shadowed by an earlier rule with no filter.
+    """
+    for earlier in earlier_rules:
+        if earlier.filter.__class__ is output.ElseFilter or not is_covering_rule(earlier, rule):
+            continue
+        
+        if earlier.filter is None:
+            if rule.filter.__class__ is output.ElseFilter or MAPNIK_VERSION >= 200000:
+                return True
+        
+        elif rule.filter.__class__ is output.Filter and MAPNIK_VERSION >= 200000:
+            if earlier.filter.text == rule.filter.text:
+                return True
+    
+    return False
+
+def prune_styles(styles, minzoom=None, maxzoom=None):
+    """ Given a list of output.Style objects for one layer and the layer's
+        min/max scale denominators, return a list of styles without rules
+        that can never be used or symbolizers that would draw nothing.
+    """
+    pruned = []
+    
+    for style in styles:
+        has_else = output.ElseFilter in [rule.filter.__class__ for rule in style.rules]
+        rules = []
+        
+        for rule in style.rules:
+            if minzoom is not None and rule.maxscale and rule.maxscale.value < minzoom:
+                msg('Removed rule %s from %s: below layer min_zoom %d' % (rule.filter, style.name, minzoom))
+                continue
+            
+            if maxzoom is not None and rule.minscale and rule.minscale.value >= maxzoom:
+                msg('Removed rule %s from %s: above layer max_zoom %d' % (rule.filter, style.name, maxzoom))
+                continue
+            
+            if is_unreachable_rule(rule, rules):
+                msg('Removed rule %s from %s: unreachable after earlier rules' % (rule.filter, style.name))
+                continue
+            
+            symbolizers = []
+            
+            for symbolizer in rule.symbolizers:
+                if is_invisible_symbolizer(symbolizer):
+                    msg('Removed %s from %s: draws nothing' % (symbolizer.__class__.__name__, style.name))
+                else:
+                    symbolizers.append(symbolizer)
+            
+            if not symbolizers:
+                if not has_else or rule.filter.__class__ is output.ElseFilter:
+                    msg('Removed rule %s from %s: no symbolizers left' % (rule.filter, style.name))
+                    continue
+
+                # an empty rule still keeps its features away from the ElseFilter.
+                msg('Emptied rule %s in %s: kept to preserve ElseFilter' % (rule.filter, style.name))
+            
+            rules.append(output.Rule(rule.minscale, rule.maxscale, rule.filter, symbolizers))
+        
+        if True in [bool(rule.symbolizers) for rule in rules]:
+            pruned.append(output.Style(style.name, rules))
+        else:
+            msg('Removed %s: no rules left' % style.name)
+    
+    return pruned
+
+def get_layer_rules(declarations, dirs, is_raster=False, context=None, previous=None, kinds=None, features=None):
+    """ Given a list of declarations applicable to one layer, return a list
+        of (kind, text name, rules) tuples, one for each style the layer needs.
+        
+        Text name is None for all but shield and text styles.
+        
+        If a previous list of tuples for the same layer and a set of style
+        kinds are given, only styles of those kinds are generated again and
+        the rest are taken from the previous list.
+        
+        If feature values for the layer's data are given, filters that match
+        no features are left out.
+    """
+    if features:
+        context = copy(context or CompileContext())
+        context.feature_values = features
+    
+    if is_raster:
+        generators = [('raster', lambda: [('raster', None, get_raster_rules(declarations, context))])]
+    
+    else:
+        generators = [('polygon', lambda: [('polygon', None, get_polygon_rules(declarations, context))]),
+                      ('polygon pattern', lambda: [('polygon pattern', None, get_polygon_pattern_rules(declarations, dirs, context))]),
+                      ('line', lambda: [('line', None, get_line_rules(declarations, context))]),
+                      ('line pattern', lambda: [('line pattern', None, get_line_pattern_rules(declarations, dirs, context))]),
+                      ('shield', lambda: [('shield', shield_name, shield_rules) for (shield_name, shield_rules)
+                                          in get_shield_rule_groups(declarations, dirs, context).items()]),
+                      ('text', lambda: [('text', text_name, text_rules) for (text_name, text_rules)
+                                        in get_text_rule_groups(declarations, context).items()]),
+                      ('point', lambda: [('point', None, get_point_rules(declarations, dirs, context))])]
+    
+    styles = []
+    
+    for (kind, generate) in generators:
+        if previous is None or kind in kinds:
+            styles.extend(generate())
+        else:
+            styles.extend([style for style in previous if style[0] == kind])
+    
+    return styles
+
+def declaration_style_kinds(declaration):
+    """ Return the set of style kinds from get_layer_rules() whose rules
+        might change when the given declaration is added to a layer.
+    """
+    name = declaration.property.name
+    
+    if name == 'display':
+        if declaration.value.value != 'none' and not declaration.selector.allTests():
+            # untested display: map, like the default at the top of each stylesheet
+            return set()
+    
+        return set(STYLE_KINDS)
+    
+    kinds = set([kind for (prefix, kind) in STYLE_KIND_PREFIXES if name.startswith(prefix)])
+    
+    if len(declaration.selector.elements) == 2:
+        # new text names in selectors add shield and text styles
+        kinds |= set(['shield', 'text'])
+    
+    return kinds
+
+def declaration_signature(declaration):
+    """ Return a hashable summary of a declaration, for comparing
+        declarations from separate compiles.
+    """
+    return (declaration.selector.__repr__(), declaration.property.name, repr(declaration.value.value))
+
+def layer_dependencies(declarations):
+    """ Given a list of declarations applicable to one layer, return a dictionary
+        of declaration signatures that each kind of style depends on, by kind.
+    """
+    dependencies = dict([(kind, []) for kind in STYLE_KINDS])
+    
+    for declaration in declarations:
+        for kind in declaration_style_kinds(declaration):
+            dependencies[kind].append(declaration_signature(declaration))
+    
+    return dependencies
+
+def style_fingerprint(style):
+    """ Return a hashable summary of an output.Style's rules,
+        suitable for finding styles that are identical to one another.
+    """
+    return tuple([(rule.minscale and rule.minscale.value,
+                   rule.maxscale and rule.maxscale.value,
+                   rule.filter.__class__.__name__, repr(rule.filter),
+                   tuple(map(symbolizer_signature, rule.symbolizers)))
+                  for rule in style.rules])
+
+def layer_rules_worker(args):
+    """ Call get_layer_rules() with a tuple of arguments, for multiprocessing.Pool.
+    
+        Return the rules along with the remote files, cache paths and cache
+        entries that the worker used, e.g. for images in symbolizers.
+    """
+    context = contexts.current = args[3]
+    rules = get_layer_rules(*args)
+    
+    return rules, context.remote_files, context.cache_paths, context.cache_locks.keys()
+
+def merge_worker_context(context, rules, remote_files, cache_paths, cache_entries):
+    """ Add what a layer_rules_worker() used to the context of the parent
+        process, so it's in the manifest and kept from eviction, and return
+        the rules. Cache entries are held here before the worker lets go.
+    """
+    context.remote_files.update(remote_files)
+    context.cache_paths.update(cache_paths)
+    
+    for path in cache_entries:
+        hold_cache_entry(path)
+    
+    return rules
+
+def applicable_indexes(element, declarations):
+    """ Given an XML element and a list of declarations, return the
+        list positions of the ones that match.
+    """
+    applicable = set(map(id, get_applicable_declarations(element, declarations)))
+    
+    return [index for (index, dec) in enumerate(declarations) if id(dec) in applicable]
+
+def scaled_declarations(declarations, scale):
+    """ Return copies of a list of declarations scaled by a number, in the same order.
+    """
+    if scale == 1:
+        return declarations
+    
+    scaled = []
+    
+    for declaration in declarations:
+        declaration = copy(declaration)
+        declaration.scaleBy(scale)
+        scaled.append(declaration)
+    
+    return scaled
+
+def compile_context(dirs, verbose=False, else_filters=None, merge_rules=True, optimize_cascade=True, cache_filters=False, **options):
+    """ Return a new CompileContext for compile() with its default options.
+    
+        else_filters defaults to True for Mapnik 2.0.0 and later, and if
+        cache_filters is True, filter combinations are kept in dirs.cache.
+        Other keyword arguments are passed on to CompileContext, see there
+        for a description of each.
+    """
+    if else_filters is None:
+        else_filters = (MAPNIK_VERSION >= 200000)
+    
+    cache_dir = cache_filters and dirs.cache or None
+    
+    return CompileContext(verbose, else_filters, merge_rules, optimize_cascade=optimize_cascade, cache_dir=cache_dir, **options)
+
+def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_styles=[], scale=1, jobs=1, context=None, variants=None, previous=None, **options):
     """ Compile a Cascadenik MML file, returning a cascadenik.output.Map object.
     
         Parameters:
         
           src:
-            Path to .mml file, or raw .mml file content.
+            Path or URL of .mml file, or raw .mml file content. Remote .mml
+            files, stylesheets and configs are kept in dirs.cache, and only
+            fetched again when they've changed.
           
           dirs:
             Object with directory names in 'cache', 'output', and 'source' attributes.
@@ -1481,14 +3473,116 @@ def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_style
         
           scale:
             Scale value for output map, 2 doubles the size for high-res displays.
+            If a list of scales is given, a list of maps is returned, one per
+            scale. The source is loaded, parsed and localized just once, and
+            filter combinations are made once and rescaled for each map.
+        
+          jobs:
+            Number of worker processes used to generate layer rules.
+            Output is identical to a single-process compile.
+        
+          context:
+            Optional CompileContext, used in place of verbose and any other
+            options. Its metrics can be examined afterwards.
+        
+          variants:
+            Optional list of user_styles lists. If given, a list of maps is
+            returned, one for each. The map source and user_styles are compiled
+            just once, and each variant only regenerates the styles its own
+            declarations affect. Variants can only be compiled at one scale.
+        
+          previous:
+            Optional output.Map from an earlier compile of the same source,
+            e.g. before a stylesheet was edited. Styles of layers whose
+            declarations are unchanged are reused from its dependency record
+            rather than generated again, wherever those layers have moved.
+            Only used for single-scale compiles.
+        
+        Other keyword parameters are options for a new CompileContext,
+        see compile_context() for their defaults.
     """
-    global VERBOSE
-
-    if verbose:
-        VERBOSE = True
+    if variants is not None and type(scale) in (list, tuple):
+        raise ValueError('Variants can only be compiled at a single scale')
+    
+    if previous is not None and previous.dependencies is None:
+        raise ValueError('Previous map has no dependency record, it must come from compile()')
+    
+    if context is None:
+        context = compile_context(dirs, verbose, **options)
+    
+    elif verbose or options:
+        raise TypeError('Options can not be given along with a context: %s' % ', '.join(sorted(options) or ['verbose']))
+    
+    if context.verbose:
         sys.stderr.write('\n')
     
-    msg('Targeting mapnik version: %s | %s' % (MAPNIK_VERSION, MAPNIK_VERSION_STR))
+    outer_context, contexts.current = getattr(contexts, 'current', None), context
+    
+    try:
+        try:
+            result = compile_map(src, dirs, context, srs, datasources_cfg, user_styles, scale, jobs, variants, previous)
+        finally:
+            if context.connections:
+                context.connections.close()
+            
+            contexts.current = outer_context
+        
+        if context.remote_files and not context.offline:
+            # remember what was fetched, for later offline compiles
+            update_manifest(dirs.cache, context.remote_files)
+        
+        context.cache_paths.update(context.remote_files.values())
+        
+        if context.cache_paths:
+            record_cache_access(dirs.cache, context.cache_paths)
+        
+        if context.cache_budget is not None:
+            context.count('evicted', len(evict_cache_entries(dirs.cache, context.cache_budget, context.cache_paths)))
+    
+    finally:
+        # other compiles can evict what this one used from now on
+        release_cache_entries(context)
+    
+    return result
+
+# number of compiles that compile_async() runs at once
+ASYNC_COMPILE_THREADS = 4
+
+# thread pool for compile_async(), made when it's first needed
+async_pool = None
+async_pool_lock = threading.Lock()
+
+def compile_async(src, dirs, callback=None, **kwargs):
+    """ Start compile() on a background thread and return at once, with a
+        multiprocessing.pool.AsyncResult whose get() method waits for the
+        output.Map, or raises the exception that compile() raised.
+        
+        Up to ASYNC_COMPILE_THREADS compiles run at the same time, each with
+        its own CompileContext; more wait their turn. Each one still fetches
+        remote resources on fetch_threads threads of its own. An optional
+        callback is called with each successful result on the pool's thread.
+        
+        Keyword arguments are passed to compile(). Rule generation holds the
+        interpreter lock, so use jobs to spread it over worker processes.
+    """
+    global async_pool
+    
+    async_pool_lock.acquire()
+    
+    try:
+        if async_pool is None:
+            async_pool = multiprocessing.pool.ThreadPool(ASYNC_COMPILE_THREADS)
+    finally:
+        async_pool_lock.release()
+    
+    return async_pool.apply_async(compile, (src, dirs), kwargs, callback)
+
+def compile_map(src, dirs, context, srs, datasources_cfg, user_styles, scale, jobs, variants, previous):
+    """ Compile a Cascadenik MML file with a given CompileContext.
+    
+        See compile() for a description of the arguments.
+    """
+    context.msg('Targeting mapnik version: %s | %s' % (MAPNIK_VERSION, MAPNIK_VERSION_STR))
         
     if posixpath.exists(src):
         doc = ElementTree.parse(src)
@@ -1502,16 +3596,37 @@ def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_style
             if not (src[:7] in ('http://', 'https:/', 'file://')):
                 src = "file://" + src
             try:
-                doc = ElementTree.parse(urllib.urlopen(src))
+                if src[:7] in ('http://', 'https:/'):
+                    # remote files are kept in the cache like everything else
+                    doc = ElementTree.parse(un_posix(locally_cache_remote_file(src, dirs.cache)))
+                else:
+                    doc = ElementTree.parse(urllib.urlopen(src))
             except IOError, e:
                 raise IOError('%s: %s' % (e,src))
             map_el = doc.getroot()
 
+    # fetch stylesheets and configs all at once, then their files and images
+    source_hrefs = remote_source_hrefs(map_el, dirs, datasources_cfg, user_styles)
+    
+    if context.offline:
+        require_offline_files(source_hrefs, dirs.cache)
+    else:
+        prefetch(fetch_remote_text, source_hrefs, context, dirs.cache)
+    
     expand_source_declarations(map_el, dirs, datasources_cfg)
-    declarations = extract_declarations(map_el, dirs, scale, user_styles)
     
-    # a list of layers and a sequential ID generator
-    layers, ids = [], (i for i in xrange(1, 999999))
+    # declarations are scaled later, once for each requested scale
+    declarations = extract_declarations(map_el, dirs, 1, user_styles)
+    
+    file_hrefs = remote_file_hrefs(map_el, dirs, declarations)
+    
+    if context.offline:
+        require_offline_files(file_hrefs, dirs.cache)
+    else:
+        prefetch(locally_cache_remote_file, file_hrefs, context, dirs.cache)
+    
+    # localized datasource parameters and applicable declaration indexes, by layer
+    layer_sources = []
 
 
     # Handle base datasources
@@ -1551,7 +3666,7 @@ def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_style
 
             if datasource_params.get('type') == 'shape':
                 # handle a local shapefile or fetch a remote, zipped shapefile
-                msg('Handling shapefile datasource...')
+                context.msg('Handling shapefile datasource...')
                 file_param = localize_shapefile(file_param, dirs)
 
                 # TODO - support datasource reprojection to make map srs
@@ -1559,63 +3674,237 @@ def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_style
 
             else: # ogr,raster, gdal, sqlite
                 # attempt to generically handle other file based datasources
-                msg('Handling generic datasource...')
+                context.msg('Handling generic datasource...')
                 file_param = localize_file_datasource(file_param, dirs)
 
-            msg("Localized path = %s" % un_posix(file_param))
+            context.msg("Localized path = %s" % un_posix(file_param))
             datasource_params['file'] = un_posix(file_param)
 
             # TODO - consider custom support for other mapnik datasources:
             # sqlite, oracle, osm, kismet, gdal, raster, rasterlite
 
-        layer_declarations = get_applicable_declarations(layer_el, declarations)
+        indexes = applicable_indexes(layer_el, declarations)
+        features = None
         
-        # a list of styles
-        styles = []
+        if context.prune_by_data and datasource_params.get('type') == 'shape':
+            shp_path = posixpath.join(dirs.output, to_posix(datasource_params['file']))
+            encoding = datasource_params.get('encoding', 'utf-8')
+            features = shapefile_feature_values(shp_path, [declarations[index] for index in indexes], encoding)
         
-        if datasource_params.get('type', None) == 'gdal':
-            styles.append(output.Style('raster style %d' % ids.next(),
-                                       get_raster_rules(layer_declarations)))
+        layer_sources.append((layer_el, datasource_params, indexes, indexes, set(), features))
     
-        else:
-            styles.append(output.Style('polygon style %d' % ids.next(),
-                                       get_polygon_rules(layer_declarations)))
+    map_indexes = applicable_indexes(map_el, declarations)
+    
+    # if a target srs is profiled, override whatever is in mml
+    if srs is not None:
+        map_el.set('srs', srs)
+    
+    if variants is not None:
+        return compile_variant_maps(map_el, layer_sources, map_indexes,
+                                    scaled_declarations(declarations, scale),
+                                    dirs, context, scale, jobs, variants)
+    
+    if type(scale) in (list, tuple):
+        return [compile_scaled_map(map_el, layer_sources, map_indexes,
+                                   scaled_declarations(declarations, one_scale),
+                                   dirs, context, jobs)
+                for one_scale in scale]
+    
+    return compile_scaled_map(map_el, layer_sources, map_indexes,
+                              scaled_declarations(declarations, scale),
+                              dirs, context, jobs, False, previous)
+
+def compile_variant_maps(map_el, layer_sources, map_indexes, declarations, dirs, context, scale, jobs, variants):
+    """ Generate a list of output.Maps, one for each list of user styles in variants.
+    
+        Rules for the base declarations are generated once. Each variant
+        then regenerates only the styles of layers that its own declarations
+        apply to, and only the kinds of styles those declarations affect.
+    """
+    # rules for the base declarations stay in the context for every variant
+    compile_scaled_map(map_el, layer_sources, map_indexes, declarations, dirs, context, jobs)
+    
+    # layer rules are keyed on declaration identity, so keep every variant's
+    # declarations alive until the last variant has been compiled.
+    maps, all_declarations = [], []
+    
+    for user_styles in variants:
+        # stylesheets were already removed from map_el, so only user styles are read here
+        overrides = scaled_declarations(extract_declarations(map_el, dirs, 1, user_styles), scale)
+        variant_declarations = declarations + overrides
+        all_declarations.append(variant_declarations)
+        
+        # declarations from user styles come after the base ones
+        offset = len(declarations)
+        variant_sources = []
+        
+        for layer_source in layer_sources:
+            (layer_el, datasource_params, indexes) = layer_source[:3]
+            features = layer_source[5]
+            override_indexes = applicable_indexes(layer_el, overrides)
+            kinds = set()
+            
+            for index in override_indexes:
+                kinds |= declaration_style_kinds(overrides[index])
+            
+            variant_indexes = indexes + [offset + index for index in override_indexes]
+            variant_sources.append((layer_el, datasource_params, variant_indexes, indexes, kinds, features))
+        
+        variant_map_indexes = map_indexes + [offset + index for index in applicable_indexes(map_el, overrides)]
+        
+        maps.append(compile_scaled_map(map_el, variant_sources, variant_map_indexes,
+                                       variant_declarations, dirs, context, jobs, True))
+    
+    return maps
+
+def compile_scaled_map(map_el, layer_sources, map_indexes, declarations, dirs, context, jobs, keep_rules=False, previous_map=None):
+    """ Generate styles and layers for a single scale, returning an output.Map.
     
-            styles.append(output.Style('polygon pattern style %d' % ids.next(),
-                                       get_polygon_pattern_rules(layer_declarations, dirs)))
+        Layer sources are (layer element, datasource parameters, declaration
+        indexes, base declaration indexes, style kinds, feature values) tuples,
+        with indexes into the list of scaled declarations. If rules for the base
+        indexes are already known, only styles of the given kinds are generated.
+        
+        Layer rules from an earlier call are kept if keep_rules is True.
+        
+        Styles whose declarations haven't changed since previous_map was
+        compiled are reused from its dependency record.
+    """
+    # names and caches are only meaningful within a single compile,
+    # because layer rules are keyed on the identity of declarations.
+    context.last_id, context.shared_styles = 0, {}
+    
+    if not keep_rules:
+        context.layer_rules = {}
+    
+    # a list of layers, and caches from the context
+    layers = []
+    layer_rules, shared_styles = context.layer_rules, context.shared_styles
+    
+    # arguments to get_layer_rules() and per-layer details, in layer order
+    rules_args, layer_args = [], []
+    
+    # record of what each layer's styles depend on, for later recompiles
+    options = (context.else_filters, context.merge_rules, context.optimize_cascade,
+               context.prune_by_data, dirs.output, dirs.cache, dirs.source)
+    dependencies = {'options': options, 'layers': []}
+    
+    # previous dependencies and rules by layer, so layers can be added or moved
+    if previous_map and previous_map.dependencies['options'] == options:
+        previous_layers = dict([(old_key, (old_depends, old_rules))
+                                for (old_key, old_depends, old_rules)
+                                in previous_map.dependencies['layers']])
+    else:
+        previous_layers = {}
+    
+    for (position, layer_source) in enumerate(layer_sources):
+        (layer_el, datasource_params, indexes, base_indexes, kinds, features) = layer_source
+        layer_declarations = [declarations[index] for index in indexes]
+        
+        is_raster = (datasource_params.get('type', None) == 'gdal')
+        
+        layer_key = (layer_el.get('id', None), layer_el.get('class', None),
+                     tuple(sorted(datasource_params.items())), features and frozenset(features[2]))
+        layer_depends = layer_dependencies(layer_declarations)
+        
+        # layers with the same applicable declarations get the same rules, so
+        # generate them once per unique set. Declarations are compared by
+        # identity, which is safe while the declarations list is alive.
+        rules_key = (tuple([id(dec) for dec in layer_declarations]), is_raster, features and features[0])
+        base_key = (tuple([id(declarations[index]) for index in base_indexes]), is_raster, features and features[0])
+        
+        # the same layer in a previous compile can lend unchanged styles
+        if layer_key in previous_layers:
+            (previous_depends, previous_rules) = previous_layers[layer_key]
+            changed_kinds = set([kind for kind in STYLE_KINDS if layer_depends[kind] != previous_depends[kind]])
+        else:
+            previous_rules = None
+        
+        if rules_key in layer_rules:
+            context.msg('Reusing rules for %d declarations' % len(layer_declarations))
+            context.count('reused layer rules')
+        
+        elif previous_rules is not None and not changed_kinds:
+            context.msg('Reusing rules from previous compile for layer %d' % position)
+            context.count('reused layer rules')
+            layer_rules[rules_key] = previous_rules
+        
+        elif previous_rules is not None:
+            context.msg('Regenerating %s styles for layer %d' % (', '.join(sorted(changed_kinds)), position))
+            layer_rules[rules_key] = None
+            rules_args.append((rules_key, (layer_declarations, dirs, is_raster, context, previous_rules, changed_kinds, features)))
+        
+        else:
+            # with known rules for the base declarations, only some kinds change
+            previous = layer_rules.get(base_key, None)
+            layer_rules[rules_key] = None
+            rules_args.append((rules_key, (layer_declarations, dirs, is_raster, context, previous, kinds, features)))
+        
+        layer_args.append((layer_el, datasource_params, rules_key))
+        dependencies['layers'].append((layer_key, layer_depends, rules_key))
     
-            styles.append(output.Style('line style %d' % ids.next(),
-                                       get_line_rules(layer_declarations)))
+    # rules are generated separately from naming, so that they can be farmed
+    # out to worker processes while styles are still numbered in layer order.
+    if jobs > 1 and len(rules_args) > 1:
+        context.msg('Generating rules for %d layers in %d processes' % (len(rules_args), jobs))
+        pool = multiprocessing.Pool(jobs)
+        
+        try:
+            results = pool.map(layer_rules_worker, [args for (key, args) in rules_args])
+            results = [merge_worker_context(context, *result) for result in results]
+        finally:
+            pool.terminate()
+    else:
+        results = [get_layer_rules(*args) for (key, args) in rules_args]
     
-            styles.append(output.Style('line pattern style %d' % ids.next(),
-                                       get_line_pattern_rules(layer_declarations, dirs)))
+    for ((rules_key, args), rules) in zip(rules_args, results):
+        layer_rules[rules_key] = rules
     
-            for (shield_name, shield_rules) in get_shield_rule_groups(layer_declarations, dirs).items():
-                styles.append(output.Style('shield style %d (%s)' % (ids.next(), shield_name), shield_rules))
+    context.count('generated layer rules', len(rules_args))
     
-            for (text_name, text_rules) in get_text_rule_groups(layer_declarations).items():
-                styles.append(output.Style('text style %d (%s)' % (ids.next(), text_name), text_rules))
+    for (layer_el, datasource_params, rules_key) in layer_args:
     
-            styles.append(output.Style('point style %d' % ids.next(),
-                                       get_point_rules(layer_declarations, dirs)))
-                                   
+        # a list of styles
+        styles = []
+        
+        for (kind, text_name, rules) in layer_rules[rules_key]:
+            if text_name is None:
+                styles.append(output.Style('%s style %d' % (kind, context.next_id()), rules))
+            else:
+                styles.append(output.Style('%s style %d (%s)' % (kind, context.next_id(), text_name), rules))
+        
+        minzoom = layer_el.get('min_zoom', None) and int(layer_el.get('min_zoom')) or None
+        maxzoom = layer_el.get('max_zoom', None) and int(layer_el.get('max_zoom')) or None
+        
         styles = [s for s in styles if s.rules]
+        rule_count = sum([len(s.rules) for s in styles])
+        
+        styles = prune_styles(styles, minzoom, maxzoom)
+        context.count('pruned rules', rule_count - sum([len(s.rules) for s in styles]))
+        
+        for style in styles:
+            context.count(style_fingerprint(style) in shared_styles and 'shared styles' or 'styles')
+        
+        styles = [shared_styles.setdefault(style_fingerprint(s), s) for s in styles]
         
         if styles:
             datasource = output.Datasource(**datasource_params)
             
-            layer = output.Layer('layer %d' % ids.next(),
+            layer = output.Layer('layer %d' % context.next_id(),
                                  datasource, styles,
                                  layer_el.get('srs', None),
-                                 layer_el.get('min_zoom', None) and int(layer_el.get('min_zoom')) or None,
-                                 layer_el.get('max_zoom', None) and int(layer_el.get('max_zoom')) or None)
+                                 minzoom, maxzoom)
     
             layers.append(layer)
+            context.count('layers')
     
-    map_attrs = get_map_attributes(get_applicable_declarations(map_el, declarations))
+    for (name, amount) in sorted(context.metrics.items()):
+        context.msg('%s: %d' % (name, amount))
     
-    # if a target srs is profiled, override whatever is in mml
-    if srs is not None:
-        map_el.set('srs', srs)
+    # rules keys mean nothing outside of this compile, so record the rules themselves
+    dependencies['layers'] = [(layer_key, layer_depends, layer_rules[rules_key])
+                              for (layer_key, layer_depends, rules_key) in dependencies['layers']]
+    
+    map_attrs = get_map_attributes([declarations[index] for index in map_indexes])
     
-    return output.Map(map_el.attrib.get('srs', None), layers, **map_attrs)
+    return output.Map(map_el.attrib.get('srs', None), layers, dependencies=dependencies, **map_attrs)
@@ -0,0 +1,95 @@
+""" Minimal reader for the dBase attribute files that accompany shapefiles.
+
+Only reads what's needed to learn which attribute values occur in the data,
+see compile.shapefile_feature_values().
+"""
+import struct
+
+def field_value(type, raw, decimals, encoding):
+    """ Convert one raw field from a record to a Python value, or None if empty.
+    """
+    raw = raw.strip(' \x00')
+
+    if not raw or raw.startswith('*'):
+        # empty, or numeric overflow
+        return None
+
+    if type in ('N', 'F'):
+        try:
+            if type == 'N' and decimals == 0:
+                return int(raw)
+            return float(raw)
+        except ValueError:
+            return None
+
+    if type == 'L':
+        if raw in 'YyTt':
+            return True
+        elif raw in 'NnFf':
+            return False
+        return None
+
+    return raw.decode(encoding, 'replace')
+
+def read_fields(file):
+    """ Given an open .dbf file, return record count, header length,
+        record length, and a list of (name, type, length, decimals) fields.
+    """
+    header = file.read(32)
+
+    if len(header) < 32:
+        raise IOError('Truncated dBase header')
+
+    count, header_length, record_length = struct.unpack('<xxxxIHH20x', header)
+    fields = []
+
+    while True:
+        descriptor = file.read(32)
+
+        if not descriptor or descriptor[0] == '\r':
+            break
+
+        if len(descriptor) < 32:
+            raise IOError('Truncated dBase field descriptor')
+
+        name, type, length, decimals = struct.unpack('<11sc4xBB14x', descriptor)
+        fields.append((name.split('\x00')[0], type, length, decimals))
+
+    return count, header_length, record_length, fields
+
+def read_records(path, names=None, encoding='utf-8'):
+    """ Generate one dictionary for each undeleted record in a .dbf file.
+
+        Optionally limit each dictionary to the named fields.
+    """
+    file = open(path, 'rb')
+
+    try:
+        count, header_length, record_length, fields = read_fields(file)
+
+        # offsets of each wanted field within a record, after the deletion flag
+        wanted, offset = [], 1
+
+        for (name, type, length, decimals) in fields:
+            if names is None or name in names:
+                wanted.append((name, type, offset, length, decimals))
+
+            offset += length
+
+        file.seek(header_length)
+
+        for index in xrange(count):
+            record = file.read(record_length)
+
+            if len(record) < record_length:
+                break
+
+            if record[0] == '*':
+                # deleted
+                continue
+
+            yield dict([(name, field_value(type, record[offset:offset+length], decimals, encoding))
+                        for (name, type, offset, length, decimals) in wanted])
+
+    finally:
+        file.close()
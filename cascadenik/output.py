@@ -17,7 +17,7 @@ class OutputException(Exception):
     pass
 
 class Map:
-    def __init__(self, srs=None, layers=None, background=None):
+    def __init__(self, srs=None, layers=None, background=None, dependencies=None):
         assert srs is None or isinstance(srs, basestring)
         assert layers is None or type(layers) in (list, tuple)
         assert background is None or background.__class__ is style.color or background == 'transparent'
@@ -25,6 +25,9 @@ class Map:
         self.srs = safe_str(srs)
         self.layers = layers or []
         self.background = background
+        
+        # what each layer's styles depend on, from compile() for later recompiles
+        self.dependencies = dependencies
 
     def __repr__(self):
         return 'Map(%s %s)' % (self.background, repr(self.layers))
@@ -44,10 +47,15 @@ class Map:
             
             ids = count(1)
             fontsets = dict()
+            style_names = set()
             
             for layer in self.layers:
                 for style in layer.styles:
-    
+                    if style.name in style_names:
+                        # already shared by an earlier layer
+                        continue
+                    
+                    style_names.add(style.name)
                     sty = mapnik.Style()
                     
                     if MAPNIK_VERSION >= 200000:
@@ -55,7 +63,11 @@ class Map:
                     
                     for rule in style.rules:
                         rul = mapnik.Rule('rule %d' % ids.next())
-                        rul.filter = rule.filter and mapnik.Filter(rule.filter.text) or rul.filter
+                        if rule.filter.__class__ is ElseFilter:
+                            rul.set_else(True)
+                        else:
+                            rul.filter = rule.filter and mapnik.Filter(rule.filter.text) or rul.filter
+
                         rul.min_scale = rule.minscale and rule.minscale.value or rul.min_scale
                         rul.max_scale = rule.maxscale and rule.maxscale.value or rul.max_scale
                         
@@ -115,7 +127,7 @@ class Rule:
     def __init__(self, minscale, maxscale, filter, symbolizers):
         assert minscale is None or minscale.__class__ is MinScaleDenominator
         assert maxscale is None or maxscale.__class__ is MaxScaleDenominator
-        assert filter is None or filter.__class__ is Filter
+        assert filter is None or filter.__class__ in (Filter, ElseFilter)
 
         self.minscale = minscale
         self.maxscale = maxscale
@@ -177,6 +189,12 @@ class Filter:
     def __repr__(self):
         return str(self.text)
 
+class ElseFilter:
+    """ Matches features that no other rule in the same style has matched.
+    """
+    def __repr__(self):
+        return 'ElseFilter'
+
 class PolygonSymbolizer:
     def __init__(self, color, opacity=None, gamma=None):
         assert color.__class__ is style.color
@@ -184,7 +202,7 @@ class PolygonSymbolizer:
         assert gamma is None or type(gamma) in (int, float)
 
         self.color = color
-        self.opacity = opacity or 1.0
+        self.opacity = 1.0 if opacity is None else opacity
         self.gamma = gamma
 
     def __repr__(self):
@@ -204,7 +222,7 @@ class RasterSymbolizer:
         assert scaling is None or isinstance(scaling, basestring)
 
         self.mode = safe_str(mode)
-        self.opacity = opacity or 1.0
+        self.opacity = 1.0 if opacity is None else opacity
         self.scaling = safe_str(scaling)
 
     def __repr__(self):
@@ -247,7 +265,7 @@ class LineSymbolizer:
                       'bevel': mapnik.line_join.BEVEL_JOIN}
     
         stroke = mapnik.Stroke(mapnik.Color(str(self.color)), self.width)
-        stroke.opacity = self.opacity or stroke.opacity
+        stroke.opacity = stroke.opacity if self.opacity is None else self.opacity
         stroke.line_cap = self.cap and line_caps[self.cap] or stroke.line_cap
         stroke.line_join = self.join and line_joins[self.join] or stroke.line_join
 
@@ -1,12 +1,11 @@
 import ConfigParser
 import StringIO
 import urlparse
-import urllib
 
 from . import mapnik
 
 class DataSources(object):
-    def __init__(self, base, local_cfg):
+    def __init__(self, base, local_cfg, cache_dir=None):
         self.templates = set([])
         self.sources = {}
         self.defaults = {}
@@ -23,7 +22,7 @@ class DataSources(object):
         if local_cfg:
             self.local_cfg_url = urlparse.urljoin(base, local_cfg)
             self.msg("Using local datasource config: %s" % self.local_cfg_url)
-            self.set_local_cfg_data(urllib.urlopen(self.local_cfg_url).read().decode(compile.DEFAULT_ENCODING))
+            self.set_local_cfg_data(compile.fetch_remote_text(self.local_cfg_url, cache_dir))
             
     def set_local_cfg_data(self, data):
         self.local_cfg_data = data
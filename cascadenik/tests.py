@@ -11,10 +11,19 @@ import shutil
 import urllib
 import urlparse
 import os.path
+import socket
+import struct
+import base64
 import unittest
 import tempfile
+import zipfile
+import StringIO
+import threading
+import BaseHTTPServer
 import xml.etree.ElementTree
 
+from time import time, sleep
+
 from .style import color, numbers, strings, boolean
 from .style import Property, Selector, SelectorElement, SelectorAttributeTest
 from .parse import ParseException, postprocess_value, stylesheet_declarations
@@ -22,11 +31,16 @@ from .compile import tests_filter_combinations, Filter, selectors_tests
 from .compile import filtered_property_declarations, is_applicable_selector
 from .compile import get_polygon_rules, get_line_rules, get_text_rule_groups, get_shield_rule_groups
 from .compile import get_point_rules, get_polygon_pattern_rules, get_line_pattern_rules
-from .compile import test2str, compile
-from .compile import Directories
+from .compile import test2str, compile, prune_styles, numpy, Image
+from .compile import CompileContext, compile_context, cached_filter_combinations, shapefile_feature_values
+from .compile import FilterEngine, DifferentialFilterEngine
+from .compile import ConnectionPool, locally_cache_remote_file, read_cache_meta, read_manifest
+from .compile import write_cache_meta, write_failure_meta, evict_cache_entries, record_cache_access, lock_cache_entry, unlock_cache_entry
+from .compile import release_cache_entries, unzip_shapefile_into, prefetch, fetch_remote_text
+from .compile import Directories, compile_async, contexts, current_context
 from .sources import DataSources
 from . import mapnik, MAPNIK_VERSION
-from . import output
+from . import output, dbf
     
 class ParseTests(unittest.TestCase):
     
@@ -611,6 +625,142 @@ class FilterCombinationTests(unittest.TestCase):
         self.assertEqual(len(filters), 16)
         self.assertEqual(str(sorted(filters)), '[[horse!=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure!=park], [horse!=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure=park], [horse!=yes][landuse=agriculture][leisure!=park], [horse!=yes][landuse=agriculture][leisure=park], [horse!=yes][landuse=civilian][leisure!=park], [horse!=yes][landuse=civilian][leisure=park], [horse!=yes][landuse=military][leisure!=park], [horse!=yes][landuse=military][leisure=park], [horse=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure!=park], [horse=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure=park], [horse=yes][landuse=agriculture][leisure!=park], [horse=yes][landuse=agriculture][leisure=park], [horse=yes][landuse=civilian][leisure!=park], [horse=yes][landuse=civilian][leisure=park], [horse=yes][landuse=military][leisure!=park], [horse=yes][landuse=military][leisure=park]]')
 
+    @unittest.skipIf(not numpy, 'NumPy is not installed')
+    def testFilters5(self):
+        s = """
+            Layer { polygon-fill: #fff; line-width: 1; }
+            Layer[landuse=military] { polygon-fill: #000; }
+            Layer[landuse=civilian] { polygon-fill: #001; display: none; }
+            Layer[horse=yes] { line-width: 2; }
+            Layer[horse=no][landuse=military] { line-color: #f00; }
+            Layer[scale-denominator>10000] { polygon-fill: #f0f; }
+            Layer[area>100][area<1000] { polygon-fill: #0ff; }
+            Layer[area=500] { display: none; }
+        """
+        declarations = stylesheet_declarations(s)
+        
+        for property_names in (['polygon-fill'], ['line-width', 'line-color'], ['point-file']):
+            rules = filtered_property_declarations(declarations, property_names[:])
+            numpy_rules = filtered_property_declarations(declarations, property_names[:], CompileContext(use_numpy=True))
+            
+            self.assertEqual(repr(rules), repr(numpy_rules))
+
+    def testFilters6(self):
+        s = """
+            Layer[landuse=military]     { polygon-fill: #000; }
+            Layer[landuse=civilian]     { polygon-fill: #001; }
+            Layer[horse=yes]    { polygon-fill: #011; }
+            Layer[scale-denominator>1000] { polygon-fill: #100; }
+        """
+        selectors = [dec.selector for dec in stylesheet_declarations(s)]
+        tests = selectors_tests(selectors)
+        filters = tests_filter_combinations(tests)
+        
+        cache_dir = tempfile.mkdtemp(prefix='cascadenik-filters-')
+        
+        try:
+            # once to write the cache, and again to read from it
+            self.assertEqual(repr(filters), repr(cached_filter_combinations(tests, cache_dir)))
+            self.assertEqual(repr(filters), repr(cached_filter_combinations(tests, cache_dir)))
+            self.assertEqual(1, len(os.listdir(os.path.join(cache_dir, 'filter-combinations'))))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def testFilters7(self):
+        s = """
+            Layer[landuse=military]     { polygon-fill: #000; }
+            Layer[landuse=civilian]     { polygon-fill: #001; }
+            Layer[lanes>2]              { polygon-fill: #011; }
+        """
+        declarations = stylesheet_declarations(s)
+        
+        # a .dbf file with only civilian landuse and two lanes
+        fields = [('landuse', 'C', 8, 0), ('lanes', 'N', 2, 0)]
+        records = [' civilian 2', ' civilian  ', '*military 4']
+        
+        header = struct.pack('<BBBBIHH20x', 3, 0, 1, 1, len(records), 32 * len(fields) + 33, 11)
+        header += ''.join([struct.pack('<11sc4xBB14x', name, type, length, decimals)
+                           for (name, type, length, decimals) in fields])
+        
+        data_dir = tempfile.mkdtemp(prefix='cascadenik-data-')
+        
+        try:
+            file = open(os.path.join(data_dir, 'data.dbf'), 'wb')
+            file.write(header + '\r' + ''.join(records) + '\x1a')
+            file.close()
+            
+            self.assertEqual([{'lanes': 2}, {'lanes': None}], list(dbf.read_records(file.name, ['lanes'])))
+            
+            features = shapefile_feature_values(os.path.join(data_dir, 'data.shp'), declarations)
+            
+            self.assertEqual(('landuse', 'lanes'), features[1])
+            self.assertEqual(set([(u'civilian', 2), (u'civilian', None)]), features[2])
+        finally:
+            shutil.rmtree(data_dir)
+        
+        context = CompileContext()
+        rules = get_polygon_rules(declarations, context)
+        
+        context.feature_values = features
+        pruned_rules = get_polygon_rules(declarations, context)
+        
+        # only civilian landuse is seen, but lanes might be anything
+        self.assertEqual(5, len(rules))
+        self.assertEqual(2, len(pruned_rules))
+        self.assertEqual(4, context.metrics['filters without features'])
+        
+        for rule in pruned_rules:
+            self.assertTrue(str(rule.filter).startswith("[landuse] = 'civilian'"))
+
+    def testFilters8(self):
+        s = """
+            Layer { polygon-fill: #fff; }
+            Layer[landuse=military] { polygon-fill: #000; }
+            Layer[horse=yes] { display: none; }
+        """
+        declarations = stylesheet_declarations(s)
+        
+        class ReversedEngine(FilterEngine):
+            def filter_combinations(self, tests):
+                return list(reversed(FilterEngine.filter_combinations(self, tests)))
+        
+        rules = filtered_property_declarations(declarations, ['polygon-fill'])
+        checked_rules = filtered_property_declarations(declarations, ['polygon-fill'],
+                                                       CompileContext(filter_engine=DifferentialFilterEngine(FilterEngine(), FilterEngine())))
+        
+        self.assertEqual(repr(rules), repr(checked_rules))
+        
+        context = CompileContext(filter_engine=DifferentialFilterEngine(ReversedEngine(), FilterEngine()))
+        self.assertRaises(Exception, filtered_property_declarations, declarations, ['polygon-fill'], context)
+
+    def testFilters9(self):
+        s = """
+            Layer[landuse=military]     { polygon-fill: #000; }
+            Layer[horse=yes]    { polygon-fill: #011; }
+        """
+        selectors = [dec.selector for dec in stylesheet_declarations(s)]
+        tests = selectors_tests(selectors)
+        filters = tests_filter_combinations(tests)
+        
+        cache_dir = tempfile.mkdtemp(prefix='cascadenik-filters-')
+        
+        try:
+            cached_filter_combinations(tests, cache_dir)
+            names = os.listdir(os.path.join(cache_dir, 'filter-combinations'))
+            cache_path = os.path.join(cache_dir, 'filter-combinations', names[0])
+            
+            # unreadable files are cache misses, whatever goes wrong with them
+            for content in ('cno_such_module\nFilter\n.', '\x80\x02]q\x00K\x01a.', 'garbage'):
+                open(cache_path, 'wb').write(content)
+                self.assertEqual(repr(filters), repr(cached_filter_combinations(tests, cache_dir)))
+            
+            # and so are caches that can't be written to
+            shutil.rmtree(os.path.join(cache_dir, 'filter-combinations'))
+            open(os.path.join(cache_dir, 'filter-combinations'), 'w').write('not a directory')
+            self.assertEqual(repr(filters), repr(cached_filter_combinations(tests, cache_dir)))
+        finally:
+            shutil.rmtree(cache_dir)
+
 class NestedRuleTests(unittest.TestCase):
 
     def testCompile1(self):
@@ -1040,6 +1190,34 @@ class CompatibilityTests(unittest.TestCase):
 
 class StyleRuleTests(unittest.TestCase):
 
+    # two road layers styled alike, and one park layer styled differently
+    three_layers = """<?xml version="1.0"?>
+        <Map>
+            <Stylesheet>
+                .roads { line-color: #f90; line-width: 2; }
+                #parks { polygon-fill: #0f0; }
+            </Stylesheet>
+            <Layer class="roads">
+                <Datasource>
+                    <Parameter name="type">postgis</Parameter>
+                    <Parameter name="table">planet_osm_line</Parameter>
+                </Datasource>
+            </Layer>
+            <Layer class="roads">
+                <Datasource>
+                    <Parameter name="type">postgis</Parameter>
+                    <Parameter name="table">planet_osm_roads</Parameter>
+                </Datasource>
+            </Layer>
+            <Layer id="parks">
+                <Datasource>
+                    <Parameter name="type">postgis</Parameter>
+                    <Parameter name="table">planet_osm_polygon</Parameter>
+                </Datasource>
+            </Layer>
+        </Map>
+    """
+
     def setUp(self):
         # a directory for all the temp files to be created below
         self.tmpdir = tempfile.mkdtemp(prefix='cascadenik-tests-')
@@ -1775,6 +1953,372 @@ class StyleRuleTests(unittest.TestCase):
         self.assertEqual(16, shield_rule_groups['both'][0].symbolizers[0].height)
         self.assertEqual(5, shield_rule_groups['both'][0].symbolizers[0].minimum_distance)
 
+    def testStyleRules15(self):
+        s = """
+            Layer[landuse=field] { polygon-fill: #001; }
+            Layer[landuse=meadow] { polygon-fill: #002; }
+            Layer { polygon-fill: #000; }
+        """
+
+        declarations = stylesheet_declarations(s, is_merc=True)
+        polygon_rules = get_polygon_rules(declarations, CompileContext(else_filters=True))
+
+        self.assertEqual(3, len(polygon_rules))
+
+        self.assertEqual(output.ElseFilter, polygon_rules[0].filter.__class__)
+        self.assertEqual(color(0x00, 0x00, 0x00), polygon_rules[0].symbolizers[0].color)
+
+        self.assertEqual("[landuse] = 'field'", polygon_rules[1].filter.text)
+        self.assertEqual(color(0x00, 0x00, 0x11), polygon_rules[1].symbolizers[0].color)
+
+        self.assertEqual("[landuse] = 'meadow'", polygon_rules[2].filter.text)
+        self.assertEqual(color(0x00, 0x00, 0x22), polygon_rules[2].symbolizers[0].color)
+
+    def testStyleRules15a(self):
+        s = """
+            Layer[landuse=field] { polygon-fill: #001; }
+            Layer[landuse=meadow] { display: none; }
+            Layer { polygon-fill: #000; }
+        """
+
+        declarations = stylesheet_declarations(s, is_merc=True)
+        polygon_rules = get_polygon_rules(declarations, CompileContext(else_filters=True))
+
+        # an ElseFilter here would also catch meadows, so keep the long form.
+        self.assertEqual(2, len(polygon_rules))
+        self.assertEqual(output.Filter, polygon_rules[0].filter.__class__)
+        self.assertEqual("[landuse] = 'field'", polygon_rules[1].filter.text)
+
+    def testStyleRules16(self):
+        s = """
+            Layer { line-color: #000; line-width: 1; }
+            Layer[highway=primary] { line-width: 2; }
+            Layer[highway=secondary] { line-width: 2; }
+            Layer[highway=tertiary] { line-width: 2; }
+            Layer[highway=track] { line-width: 3; }
+        """
+
+        declarations = stylesheet_declarations(s, is_merc=True)
+        line_rules = get_line_rules(declarations, CompileContext(merge_rules=True))
+
+        self.assertEqual(3, len(line_rules))
+        self.assertEqual(1.0, line_rules[0].symbolizers[0].width)
+
+        if MAPNIK_VERSION >= 200000:
+            self.assertEqual("[highway].match('^(primary|secondary|tertiary)$')", line_rules[1].filter.text)
+        else:
+            self.assertEqual("([highway] = 'primary' or [highway] = 'secondary' or [highway] = 'tertiary')", line_rules[1].filter.text)
+
+        self.assertEqual(2.0, line_rules[1].symbolizers[0].width)
+
+        self.assertEqual("[highway] = 'track'", line_rules[2].filter.text)
+        self.assertEqual(3.0, line_rules[2].symbolizers[0].width)
+
+    def testStyleRules16a(self):
+        s = """
+            Layer[zoom>10][highway=primary] { line-color: #000; line-width: 2; }
+            Layer[zoom>10][highway=secondary] { line-color: #000; line-width: 2; }
+        """
+
+        declarations = stylesheet_declarations(s, is_merc=True)
+        line_rules = get_line_rules(declarations, CompileContext(merge_rules=True))
+
+        # two alternatives are cheaper as a disjunction than as a regular expression.
+        self.assertEqual(1, len(line_rules))
+        self.assertEqual(408560, line_rules[0].maxscale.value)
+        self.assertEqual("([highway] = 'primary' or [highway] = 'secondary')", line_rules[0].filter.text)
+
+    def testStyleRules17(self):
+        s = """
+            Layer { polygon-fill: #f00; polygon-opacity: 0; }
+            Layer[landuse=park] { polygon-opacity: 1; }
+        """
+
+        declarations = stylesheet_declarations(s, is_merc=True)
+        polygon_rules = get_polygon_rules(declarations)
+
+        self.assertEqual(2, len(polygon_rules))
+        self.assertEqual(0, polygon_rules[0].symbolizers[0].opacity)
+
+        styles = prune_styles([output.Style('polygon style 1', polygon_rules)])
+
+        self.assertEqual(1, len(styles))
+        self.assertEqual(1, len(styles[0].rules))
+        self.assertEqual("[landuse] = 'park'", styles[0].rules[0].filter.text)
+
+    def testStyleRules17a(self):
+        s = """
+            Layer[zoom<=10] { polygon-fill: #f00; }
+            Layer[zoom>10] { polygon-fill: #0f0; }
+        """
+
+        declarations = stylesheet_declarations(s, is_merc=True)
+        polygon_rules = get_polygon_rules(declarations)
+
+        self.assertEqual(2, len(polygon_rules))
+
+        # the layer is never drawn at zoom levels greater than 10
+        styles = prune_styles([output.Style('polygon style 1', polygon_rules)], minzoom=500000)
+
+        self.assertEqual(1, len(styles[0].rules))
+        self.assertEqual(408561, styles[0].rules[0].minscale.value)
+        self.assertEqual(color(0xFF, 0x00, 0x00), styles[0].rules[0].symbolizers[0].color)
+
+    def testStyleRules18(self):
+        s = """
+            Layer { line-color: #000; line-width: 1; }
+            Layer[landuse=military] { line-color: #f00; }
+            Layer[landuse=military] { line-color: #0f0; }
+            Layer[horse=yes][landuse=farm] { line-width: 1; }
+        """
+
+        declarations = stylesheet_declarations(s)
+        line_rules = get_line_rules(declarations, CompileContext(optimize_cascade=True))
+
+        # the horse and farm tests can't change anything
+        self.assertEqual(2, len(line_rules))
+        self.assertEqual(line_rules[0].filter.text, "not [landuse] = 'military'")
+        self.assertEqual(line_rules[1].filter.text, "[landuse] = 'military'")
+        self.assertEqual(color(0x00, 0xFF, 0x00), line_rules[1].symbolizers[0].color)
+
+    def testStyleRules19(self):
+        context = CompileContext()
+        map = compile(self.three_layers, self.dirs, context=context)
+        
+        # identically styled layers share one style
+        line1, line2, parks = [[style.name for style in layer.styles] for layer in map.layers]
+        
+        self.assertEqual(line1, line2)
+        self.assertNotEqual(line1, parks)
+        self.assertEqual(2, context.metrics['styles'])
+
+    def testStyleRules20(self):
+        context = CompileContext()
+        compile(self.three_layers, self.dirs, context=context)
+        
+        # rules for the two road layers are generated once
+        self.assertEqual(2, context.metrics['generated layer rules'])
+        self.assertEqual(1, context.metrics['reused layer rules'])
+
+    def testStyleRules21(self):
+        style_path = os.path.join(self.tmpdir, 'blue.mss')
+        open(style_path, 'w').write('.roads[highway=primary], .roads[highway=trunk] { line-color: #00f; } #parks { polygon-fill: #00f; }')
+        
+        # the variant changes both layers, so its rules are generated in two
+        # worker processes that must see the compile context to merge rules.
+        context1 = CompileContext(merge_rules=True)
+        base1, blue1 = compile(self.three_layers, self.dirs, context=context1, variants=[[], [style_path]])
+        
+        # rules generated in worker processes are no different
+        context2 = CompileContext(merge_rules=True)
+        base2, blue2 = compile(self.three_layers, self.dirs, jobs=2, context=context2, variants=[[], [style_path]])
+        
+        self.assertEqual(context1.metrics['generated layer rules'], context2.metrics['generated layer rules'])
+        
+        for (map1, map2) in ((base1, base2), (blue1, blue2)):
+            self.assertEqual([[style.name for style in layer.styles] for layer in map1.layers],
+                             [[style.name for style in layer.styles] for layer in map2.layers])
+            self.assertEqual([str(layer.styles[0].rules[0].symbolizers[0].color) for layer in map1.layers],
+                             [str(layer.styles[0].rules[0].symbolizers[0].color) for layer in map2.layers])
+        
+        # the two highway rules were merged into one
+        self.assertEqual(['#ff9900', '#0000ff'], [str(rule.symbolizers[0].color) for rule in blue2.layers[0].styles[0].rules])
+
+    def testStyleRules22(self):
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    Layer[scale-denominator>100000] { line-color: #f90; line-width: 1; }
+                    Layer[scale-denominator&lt;=100000] { line-width: 2; }
+                    Layer[scale-denominator&lt;=100000][highway=primary] { line-color: #f00; }
+                    Layer[scale-denominator>10000] { polygon-fill: #0f0; }
+                </Stylesheet>
+                <Layer>
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_line</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        context1, context2 = CompileContext(), CompileContext()
+        map1, map2 = compile(s, self.dirs, scale=[1, 2], context=context2)
+        compile(s, self.dirs, context=context1)
+        
+        # filter combinations are made at the first scale and reused at the second
+        self.assertEqual(context1.metrics['filter combinations'], context2.metrics['filter combinations'])
+        self.assertEqual(2 * context1.metrics['reused filter combinations'] + context1.metrics['filter combinations'],
+                         context2.metrics['reused filter combinations'])
+        
+        def summary(map):
+            return [(style.name, [(str(rule.filter), rule.minscale and rule.minscale.value,
+                                   rule.maxscale and rule.maxscale.value, repr(rule.symbolizers))
+                                  for rule in style.rules])
+                    for style in map.layers[0].styles]
+        
+        # each map should look like it came from a compile of its own
+        self.assertEqual(summary(map1), summary(compile(s, self.dirs, scale=1, context=CompileContext())))
+        self.assertEqual(summary(map2), summary(compile(s, self.dirs, scale=2, context=CompileContext())))
+
+    def testStyleRules23(self):
+        map1 = compile(self.three_layers, self.dirs, context=CompileContext())
+        
+        # a new layer at the top moves all the others down
+        water = """
+            <Layer id="water">
+                <Datasource>
+                    <Parameter name="type">postgis</Parameter>
+                    <Parameter name="table">planet_osm_water</Parameter>
+                </Datasource>
+            </Layer>
+            <Layer class="roads">"""
+        
+        s = self.three_layers.replace('<Layer class="roads">', water, 1)
+        s = s.replace('#parks {', '#water { polygon-fill: #00f; } #parks {')
+        
+        context = CompileContext()
+        map2 = compile(s, self.dirs, context=context, previous=map1)
+        
+        # ...but their rules are still reused from the previous compile
+        self.assertEqual(1, context.metrics['generated layer rules'])
+        self.assertEqual(3, context.metrics['reused layer rules'])
+        self.assertEqual(['#0000ff', '#ff9900', '#ff9900', '#00ff00'],
+                         [str(layer.styles[0].rules[0].symbolizers[0].color) for layer in map2.layers])
+        
+        # a map from anywhere else has nothing to reuse
+        self.assertRaises(ValueError, compile, s, self.dirs, previous=output.Map())
+
+    def testStyleRules24(self):
+        s = """<?xml version="1.0"?>
+            <Map srs="+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null">
+                <Stylesheet>
+                    Layer[zoom=12]
+                    {
+                        line-color: #f90;
+                        line-width: 1;
+                    }
+                </Stylesheet>
+                <Layer>
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_line</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        map1, map2 = compile(s, self.dirs, scale=[1, 2])
+        
+        rule1 = map1.layers[0].styles[0].rules[0]
+        rule2 = map2.layers[0].styles[0].rules[0]
+        
+        self.assertEqual(1, rule1.symbolizers[0].width)
+        self.assertEqual(2, rule2.symbolizers[0].width)
+        self.assertEqual(102140, rule1.minscale.value)
+        self.assertEqual(51070, rule2.minscale.value)
+        
+        # each map should look like it came from a compile of its own
+        self.assertEqual(map2.layers[0].styles[0].name, compile(s, self.dirs, scale=2).layers[0].styles[0].name)
+
+    def testStyleRules25(self):
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    Layer { polygon-fill: #999; line-color: #fff; line-width: 1; }
+                </Stylesheet>
+                <Layer id="land">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="water">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        style_path = os.path.join(self.tmpdir, 'blue.mss')
+        open(style_path, 'w').write('#water { polygon-fill: #00f; }')
+
+        base, blue = compile(s, self.dirs, variants=[[], [style_path]])
+        
+        self.assertEqual(color(0x99, 0x99, 0x99), base.layers[1].styles[0].rules[0].symbolizers[0].color)
+        self.assertEqual(color(0x00, 0x00, 0xFF), blue.layers[1].styles[0].rules[0].symbolizers[0].color)
+        
+        # untouched layers and styles are reused from the base compile
+        self.assertTrue(base.layers[0].styles[0].rules[0].symbolizers[0] is blue.layers[0].styles[0].rules[0].symbolizers[0])
+        self.assertTrue(base.layers[1].styles[1].rules[0].symbolizers[0] is blue.layers[1].styles[1].rules[0].symbolizers[0])
+        
+        # each variant should look like it came from a compile of its own
+        standalone = compile(s, self.dirs, user_styles=[style_path])
+        self.assertEqual([s.name for s in blue.layers[1].styles], [s.name for s in standalone.layers[1].styles])
+
+    def testStyleRules26(self):
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    Layer { polygon-fill: #999; line-color: #fff; line-width: 1; }
+                    #water { polygon-fill: %(water)s; }
+                </Stylesheet>
+                <Layer id="land">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="water">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        before = compile(s % dict(water='#00f'), self.dirs)
+        after = compile(s % dict(water='#0ff'), self.dirs, previous=before)
+        
+        self.assertEqual(color(0x00, 0x00, 0xFF), before.layers[1].styles[0].rules[0].symbolizers[0].color)
+        self.assertEqual(color(0x00, 0xFF, 0xFF), after.layers[1].styles[0].rules[0].symbolizers[0].color)
+        
+        # unchanged layers and styles are reused from the previous compile
+        self.assertTrue(before.layers[0].styles[0].rules[0].symbolizers[0] is after.layers[0].styles[0].rules[0].symbolizers[0])
+        self.assertTrue(before.layers[1].styles[1].rules[0].symbolizers[0] is after.layers[1].styles[1].rules[0].symbolizers[0])
+
+    def testStyleRules27(self):
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    Layer { polygon-fill: #999; }
+                </Stylesheet>
+                <Layer>
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        # options for compile() make a context with its own defaults...
+        context = compile_context(self.dirs, fetch_threads=0)
+        self.assertTrue(context.merge_rules and context.optimize_cascade)
+        self.assertEqual((MAPNIK_VERSION >= 200000), context.else_filters)
+        self.assertEqual((None, 0), (context.cache_dir, context.fetch_threads))
+        self.assertEqual(self.dirs.cache, compile_context(self.dirs, cache_filters=True).cache_dir)
+        
+        # ...but can't be mixed with a context, or misspelled
+        self.assertRaises(TypeError, compile, s, self.dirs, context=CompileContext(), merge_rules=False)
+        self.assertRaises(TypeError, compile, s, self.dirs, True, context=CompileContext())
+        self.assertRaises(TypeError, compile, s, self.dirs, merge_ruels=False)
+        
+        map = compile(s, self.dirs, merge_rules=False, fetch_threads=0)
+        self.assertEqual(1, len(map.layers))
+
 class DataSourcesTests(unittest.TestCase):
 
     def gen_section(self, name, **kwargs):
@@ -1871,6 +2415,721 @@ garbage=junk
                                             estimate_extent="yes"), __file__))
 
 
+class RemoteFileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the server's dictionary of paths to file contents, with keep-alive.
+    """
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        self.server.requests.append((self.client_address, self.path, dict(self.headers)))
+        headers = self.server.headers.get(self.path, {})
+        
+        if self.server.failures.get(self.path):
+            self.server.failures[self.path] -= 1
+            body = 'Try again'
+            self.send_response(503)
+        elif 'Location' in headers:
+            body = ''
+            self.send_response(302)
+        elif self.path in self.server.files and 'ETag' in headers and self.headers.get('If-None-Match') == headers['ETag']:
+            body = ''
+            self.send_response(304)
+        elif self.path in self.server.files and 'ETag' in headers and self.headers.get('If-Range') == headers['ETag']:
+            body = self.server.files[self.path]
+            start = int(self.headers['Range'][6:-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1, len(body)))
+            body = body[start:]
+        elif self.path in self.server.files:
+            body = self.server.files[self.path]
+            self.send_response(200)
+        else:
+            body = 'Not found'
+            self.send_response(404)
+        
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        
+        if 'Content-Length' in headers:
+            # pretend the connection broke
+            self.close_connection = 1
+        else:
+            self.send_header('Content-Length', str(len(body)))
+
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class RemoteCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        # a local stand-in for a remote server
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RemoteFileHandler)
+        self.server.files = {'/one.png': 'one', '/two.png': 'two'}
+        self.server.headers = {}
+        self.server.failures = {}
+        self.server.requests = []
+        self.host = '127.0.0.1:%d' % self.server.server_port
+        
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        
+        self.tmpdir = tempfile.mkdtemp(prefix='cascadenik-tests-')
+        self.newContext()
+
+    def tearDown(self):
+        self.newContext()
+        contexts.current = None
+        
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+    
+    def newContext(self):
+        """ Start over with a new context, like a separate compile would.
+        """
+        if getattr(contexts, 'current', None) and contexts.current.connections:
+            contexts.current.connection_pool().close()
+        
+        contexts.current = CompileContext()
+
+    def testConnectionPool1(self):
+        pool = ConnectionPool()
+        
+        for path in ('/one.png', '/two.png', '/three.png'):
+            resp, body = pool.request('http', self.host, path)
+        
+        pool.close()
+        
+        self.assertEqual((404, 'Not found'), (resp.status, body))
+        self.assertEqual(3, len(self.server.requests))
+        
+        # every request arrived over the same connection
+        self.assertEqual(1, pool.opened)
+        self.assertEqual(1, len(set([address for (address, path, headers) in self.server.requests])))
+
+    def testConnectionPool2(self):
+        pool = ConnectionPool(idle_timeout=0)
+        
+        for path in ('/one.png', '/two.png'):
+            resp, body = pool.request('http', self.host, path)
+        
+        pool.close()
+        
+        self.assertEqual((200, 'two'), (resp.status, body))
+        self.assertEqual(2, pool.opened)
+
+    def testConnectionPool3(self):
+        pool = ConnectionPool(backoff=.01)
+        
+        # two server errors are retried, three are too many
+        self.server.failures['/one.png'] = 2
+        resp, body = pool.request('http', self.host, '/one.png')
+        
+        self.assertEqual((200, 'one'), (resp.status, body))
+        self.assertEqual(3, len(self.server.requests))
+        
+        self.server.failures['/two.png'] = 3
+        resp, body = pool.request('http', self.host, '/two.png')
+        pool.close()
+        
+        self.assertEqual(503, resp.status)
+        self.assertEqual(6, len(self.server.requests))
+
+    def testConnectionPool4(self):
+        # a port with nothing listening on it
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead_host = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        
+        pool = ConnectionPool(backoff=.01)
+        self.assertRaises(socket.error, pool.request, 'http', dead_host, '/one.png')
+        self.assertEqual(3, pool.opened)
+        
+        # the dead host isn't tried again
+        self.assertRaises(socket.error, pool.request, 'http', dead_host, '/two.png')
+        self.assertEqual(3, pool.opened)
+        
+        # ...for a while
+        error, failed_at = pool.unreachable[('http', dead_host)]
+        pool.unreachable[('http', dead_host)] = error, failed_at - 3600
+        self.assertRaises(socket.error, pool.request, 'http', dead_host, '/two.png')
+        self.assertEqual(6, pool.opened)
+        
+        # nothing is asked for past the deadline
+        pool = ConnectionPool(deadline=time() - 1)
+        self.assertRaises(IOError, pool.request, 'http', self.host, '/one.png')
+        self.assertEqual(0, len(self.server.requests))
+
+    def testDefaultContext1(self):
+        self.server.headers['/one.png'] = {'ETag': '"1"'}
+        href = 'http://%s/one.png' % self.host
+        
+        # outside of compile(), each call has a context of its own
+        contexts.current = None
+        context = current_context()
+        self.assertFalse(context is current_context())
+        
+        path1 = locally_cache_remote_file(href, self.tmpdir)
+        
+        # a remote change is seen by the next call
+        self.server.files['/one.png'] = 'uno'
+        self.server.headers['/one.png'] = {'ETag': '"2"'}
+        path2 = locally_cache_remote_file(href, self.tmpdir)
+        context.connection_pool().close()
+        
+        self.assertEqual(path1, path2)
+        self.assertEqual('uno', open(path2).read())
+        self.assertEqual(2, len(self.server.requests))
+        
+        # ...over the same shared connection
+        self.assertTrue(context.connections is current_context().connections)
+        self.assertEqual(1, len(set([address for (address, path, headers) in self.server.requests])))
+
+    def testRemoteCache1(self):
+        self.server.headers['/one.png'] = {'ETag': '"1"', 'Cache-Control': 'public, max-age=60'}
+        href = 'http://%s/one.png' % self.host
+        
+        path1 = locally_cache_remote_file(href, self.tmpdir)
+        path2 = locally_cache_remote_file(href, self.tmpdir)
+        
+        # the second time, the file is fresh enough to not ask again
+        self.assertEqual(path1, path2)
+        self.assertEqual('one', open(path2).read())
+        self.assertEqual(1, len(self.server.requests))
+        
+        meta = read_cache_meta(path1)
+        self.assertEqual(('"1"', 60), (meta['etag'], meta['max-age']))
+
+    def testRemoteCache2(self):
+        self.server.headers['/one.png'] = {'ETag': '"1"'}
+        href = 'http://%s/one.png' % self.host
+        
+        path1 = locally_cache_remote_file(href, self.tmpdir)
+        self.newContext()
+        path2 = locally_cache_remote_file(href, self.tmpdir)
+        
+        # the second time, the file is revalidated with its ETag
+        self.assertEqual(path1, path2)
+        self.assertEqual('one', open(path2).read())
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual('"1"', self.server.requests[1][2].get('if-none-match'))
+
+    def testRemoteCache3(self):
+        self.server.headers['/old.png'] = {'Location': '/one.png', 'Cache-Control': 'max-age=60'}
+        href = 'http://%s/old.png' % self.host
+        
+        path1 = locally_cache_remote_file(href, self.tmpdir)
+        self.newContext()
+        path2 = locally_cache_remote_file(href, self.tmpdir)
+        self.newContext()
+        
+        # the redirect is remembered, and points to the cached file for its target
+        self.assertEqual(path1, locally_cache_remote_file('http://%s/one.png' % self.host, self.tmpdir))
+        self.assertEqual(path1, path2)
+        self.assertEqual(['/old.png', '/one.png', '/one.png', '/one.png'], [path for (address, path, headers) in self.server.requests])
+        self.assertEqual(1, len([name for name in os.listdir(self.tmpdir) if not name.endswith('.meta') and not name.endswith('.lock')]))
+
+    def testRemoteCache4(self):
+        self.server.headers['/one.png'] = {'Content-Length': '10'}
+        href = 'http://%s/one.png' % self.host
+        
+        self.assertRaises(IOError, locally_cache_remote_file, href, self.tmpdir)
+        
+        # nothing is left behind that looks like a complete file
+        self.assertEqual([], [name for name in os.listdir(self.tmpdir) if not name.endswith('.lock')])
+
+    def testRemoteCache5(self):
+        self.server.files['/big.zip'] = 'abcdefghij'
+        self.server.headers['/big.zip'] = {'ETag': '"1"'}
+        href = 'http://%s/big.zip' % self.host
+        
+        # an interrupted download of the same file
+        local_path = locally_cache_remote_file(href, self.tmpdir)
+        os.rename(local_path, local_path + '.part')
+        open(local_path + '.part', 'r+').truncate(4)
+        write_cache_meta(local_path + '.part', {'etag': '"1"', 'last-modified': None})
+        
+        self.newContext()
+        self.assertEqual(local_path, locally_cache_remote_file(href, self.tmpdir))
+        self.assertEqual('abcdefghij', open(local_path).read())
+        self.assertEqual('bytes=4-', self.server.requests[-1][2].get('range'))
+        self.assertFalse(os.path.exists(local_path + '.part'))
+
+    def testRemoteCache6(self):
+        href = 'http://%s/three.png' % self.host
+        self.assertRaises(Exception, locally_cache_remote_file, href, self.tmpdir)
+        
+        # a missing file is remembered for a while
+        self.server.files['/three.png'] = 'three'
+        self.assertRaises(Exception, locally_cache_remote_file, href, self.tmpdir)
+        self.assertEqual(1, len(self.server.requests))
+        
+        # ...and then asked for again
+        local_path = os.path.join(self.tmpdir, [name for name in os.listdir(self.tmpdir) if name.endswith('.meta')][0][:-5])
+        meta = read_cache_meta(local_path)
+        self.assertEqual(404, meta['failed'])
+        
+        meta['failed-at'] -= 3600
+        write_cache_meta(local_path, meta)
+        
+        self.assertEqual(local_path, locally_cache_remote_file(href, self.tmpdir))
+        self.assertEqual('three', open(local_path).read())
+        self.assertEqual(None, read_cache_meta(local_path).get('failed'))
+
+    def testRemoteCache7(self):
+        # a host that accepts connections but never answers
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        href = 'http://127.0.0.1:%d/one.png' % sock.getsockname()[1]
+        
+        try:
+            contexts.current = CompileContext(fetch_budget=.2)
+            self.assertRaises(IOError, locally_cache_remote_file, href, self.tmpdir)
+        finally:
+            sock.close()
+        
+        # running out of time isn't the host's fault, so it's not remembered
+        metas = [read_cache_meta(os.path.join(self.tmpdir, name[:-5])) for name in os.listdir(self.tmpdir) if name.endswith('.meta')]
+        self.assertEqual([], [meta for meta in metas if meta and meta.get('failed')])
+
+    def testRemoteCache8(self):
+        self.server.headers['/one.png'] = {'ETag': '"1"'}
+        href = 'http://%s/one.png' % self.host
+        local_path = locally_cache_remote_file(href, self.tmpdir)
+        
+        # a recent failure to update the file falls back to the cached copy
+        write_failure_meta(local_path, read_cache_meta(local_path), 503)
+        
+        self.newContext()
+        self.assertEqual(local_path, locally_cache_remote_file(href, self.tmpdir))
+        self.assertEqual('one', open(local_path).read())
+        self.assertEqual(1, len(self.server.requests))
+
+    def testRemoteCache9(self):
+        self.server.failures['/one.png'] = 3
+        self.server.failures['/style.mss'] = 3
+        self.server.files['/style.mss'] = 'Layer { polygon-fill: #999; }'
+        
+        context = contexts.current
+        context.connections = ConnectionPool(backoff=.01)
+        
+        hrefs = ['http://%s/one.png' % self.host, 'http://%s/style.mss' % self.host]
+        prefetch(locally_cache_remote_file, hrefs[:1], context, self.tmpdir)
+        prefetch(fetch_remote_text, hrefs[1:], context, self.tmpdir)
+        self.assertEqual(6, len(self.server.requests))
+        
+        # failures are raised again without asking a second time
+        self.assertRaises(Exception, locally_cache_remote_file, hrefs[0], self.tmpdir)
+        self.assertRaises(Exception, fetch_remote_text, hrefs[1], self.tmpdir)
+        self.assertEqual(6, len(self.server.requests))
+        self.assertEqual(hrefs, sorted(context.remote_failures.keys()))
+
+    def testRemoteCache10(self):
+        self.server.headers['/one.png'] = {'ETag': '"1"'}
+        href = 'http://%s/one.png' % self.host
+        local_path = locally_cache_remote_file(href, self.tmpdir)
+        
+        # the server goes away
+        self.newContext()
+        self.server.shutdown()
+        self.server.server_close()
+        
+        # the first failure already falls back to the cached copy
+        contexts.current.connections = ConnectionPool(backoff=.01)
+        
+        self.assertEqual(local_path, locally_cache_remote_file(href, self.tmpdir))
+        self.assertEqual('one', open(local_path).read())
+        self.assertTrue(read_cache_meta(local_path).get('failed'))
+
+    def testRemoteCache11(self):
+        self.server.headers['/one.png'] = {'ETag': '"1"'}
+        href = 'http://%s/one.png' % self.host
+        local_path = locally_cache_remote_file(href, self.tmpdir)
+        
+        # a file removed from the server is removed from the cache
+        del self.server.files['/one.png']
+        self.newContext()
+        
+        self.assertRaises(Exception, locally_cache_remote_file, href, self.tmpdir)
+        self.assertFalse(os.path.exists(local_path))
+        self.assertEqual(404, read_cache_meta(local_path)['failed'])
+        
+        # ...and keeps failing without asking again
+        self.newContext()
+        self.assertRaises(Exception, locally_cache_remote_file, href, self.tmpdir)
+        self.assertEqual(2, len(self.server.requests))
+
+    def testRemoteCache12(self):
+        self.server.headers['/loop.png'] = {'Location': '/loop.png'}
+        self.server.headers['/a.png'] = {'Location': '/b.png'}
+        self.server.headers['/b.png'] = {'Location': '/a.png'}
+        
+        # redirect loops fail rather than wait on their own locks
+        self.assertRaises(Exception, locally_cache_remote_file, 'http://%s/loop.png' % self.host, self.tmpdir)
+        self.assertRaises(Exception, locally_cache_remote_file, 'http://%s/a.png' % self.host, self.tmpdir)
+        self.assertEqual(['/loop.png', '/a.png', '/b.png'], [path for (address, path, headers) in self.server.requests])
+        
+        # and so do long chains of redirects
+        for index in range(10):
+            self.server.headers['/%d.png' % index] = {'Location': '/%d.png' % (index + 1)}
+        
+        self.assertRaises(Exception, locally_cache_remote_file, 'http://%s/0.png' % self.host, self.tmpdir)
+        self.assertEqual(6, len([path for (address, path, headers) in self.server.requests if path[1].isdigit()]))
+
+    def testRemoteCompile1(self):
+        self.server.files['/style.mss'] = 'Layer { polygon-fill: #999; }'
+        self.server.files['/map.mml'] = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet src="style.mss"/>
+                <Layer>
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        self.server.headers['/style.mss'] = {'ETag': '"1"'}
+        self.server.headers['/map.mml'] = {'ETag': '"1"'}
+        
+        src = 'http://%s/map.mml' % self.host
+        dirs = Directories(self.tmpdir, self.tmpdir, 'http://%s/' % self.host)
+        
+        map1 = compile(src, dirs)
+        map2 = compile(src, dirs)
+        
+        # the second compile only revalidates the map and stylesheet
+        self.assertEqual(['/map.mml', '/style.mss'] * 2, [path for (address, path, headers) in self.server.requests])
+        self.assertEqual(['"1"', '"1"'], [headers.get('if-none-match') for (address, path, headers) in self.server.requests[2:]])
+        self.assertEqual(map1.layers[0].styles[0].rules[0].symbolizers[0].color, map2.layers[0].styles[0].rules[0].symbolizers[0].color)
+        
+        # with max-age, a third compile makes no requests at all
+        self.server.headers['/style.mss']['Cache-Control'] = 'max-age=60'
+        self.server.headers['/map.mml']['Cache-Control'] = 'max-age=60'
+        
+        compile(src, dirs)
+        compile(src, dirs)
+        
+        self.assertEqual(6, len(self.server.requests))
+
+    def testRemoteCompile2(self):
+        self.server.files['/style.mss'] = 'Layer { polygon-fill: #999; }'
+        self.server.files['/map.mml'] = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet src="style.mss"/>
+                <Layer>
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        dirs = Directories(self.tmpdir, self.tmpdir, 'http://%s/' % self.host)
+        maps = []
+        
+        # several compiles at once, each with its own context
+        results = [compile_async('http://%s/map.mml' % self.host, dirs, maps.append, scale=scale)
+                   for scale in (1, 2, 1)]
+        
+        map1, map2, map3 = [result.get(30) for result in results]
+        
+        self.assertEqual(3, len(maps))
+        self.assertEqual('#999999', str(map1.layers[0].styles[0].rules[0].symbolizers[0].color))
+        self.assertEqual(map1.layers[0].styles[0].rules[0].symbolizers[0].color, map3.layers[0].styles[0].rules[0].symbolizers[0].color)
+        self.assertEqual(map1.layers[0].name, map3.layers[0].name)
+        
+        # exceptions come back from get()
+        result = compile_async('http://%s/missing.mml' % self.host, dirs)
+        self.assertRaises(Exception, result.get, 30)
+
+    @unittest.skipIf(not Image, 'PIL is not installed')
+    def testRemoteCompile3(self):
+        # a one-pixel PNG
+        self.server.files['/dot.png'] = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+        href = 'http://%s/dot.png' % self.host
+        
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    #points { point-file: url('%s'); }
+                    #areas { polygon-fill: #999; }
+                </Stylesheet>
+                <Layer id="points">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_point</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="areas">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % href
+        
+        # without prefetching, the image is fetched by a worker process
+        dirs = Directories(self.tmpdir, self.tmpdir, self.tmpdir)
+        context = CompileContext(fetch_threads=0)
+        cwd = os.getcwd()
+        
+        try:
+            # converted images are written relative to the output directory
+            os.chdir(self.tmpdir)
+            compile(s, dirs, jobs=2, context=context)
+        finally:
+            os.chdir(cwd)
+        
+        # ...and still recorded by the parent
+        self.assertEqual(1, len(self.server.requests))
+        self.assertTrue(href in context.remote_files)
+        self.assertTrue(href in read_manifest(self.tmpdir))
+        self.assertTrue(context.remote_files[href] in context.cache_paths)
+
+    def testRemoteCompile4(self):
+        buffer = StringIO.StringIO()
+        zip_file = zipfile.ZipFile(buffer, 'w')
+        
+        for ext in ('.shp', '.shx', '.dbf'):
+            zip_file.writestr('points' + ext, 'x' * 10)
+        
+        zip_file.close()
+        self.server.files['/points.zip'] = buffer.getvalue()
+        
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    Layer { polygon-fill: #999; }
+                </Stylesheet>
+                <Layer id="one">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">points.zip</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="two">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">points.zip</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        dirs = Directories(self.tmpdir, self.tmpdir, 'http://%s/' % self.host)
+        context = CompileContext(fetch_threads=2)
+        map = compile(s, dirs, context=context)
+        
+        # the shared remote file is fetched once, before the layers need it
+        self.assertEqual(1, context.metrics['prefetched'])
+        self.assertEqual(1, len(context.remote_files))
+        self.assertEqual(['/points.zip'], [path for (address, path, headers) in self.server.requests])
+        self.assertEqual(map.layers[0].datasource.parameters['file'], map.layers[1].datasource.parameters['file'])
+
+    def testRemoteCompile5(self):
+        self.server.files['/dot.png'] = 'x'
+        href = 'http://%s/dot.png' % self.host
+        
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    #areas { polygon-fill: #999; }
+                    #points, #missing { point-file: url('%s'); }
+                </Stylesheet>
+                <Layer id="areas">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_polygon</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="points" status="off">
+                    <Datasource>
+                        <Parameter name="type">postgis</Parameter>
+                        <Parameter name="table">planet_osm_point</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % href
+        
+        dirs = Directories(self.tmpdir, self.tmpdir, self.tmpdir)
+        context = CompileContext(fetch_threads=2)
+        map = compile(s, dirs, context=context)
+        
+        # the image applies to no enabled layer, so it's never fetched
+        self.assertEqual(1, len(map.layers))
+        self.assertEqual(0, context.metrics.get('prefetched', 0))
+        self.assertEqual([], self.server.requests)
+        self.assertFalse(href in context.remote_files)
+
+    def testCacheEviction1(self):
+        paths = [os.path.join(self.tmpdir, name) for name in
+                 ('host-00000001-a.zip', 'host-00000001-a.zip.meta', 'host-00000002-b.png', 'host-00000003-c.png', 'manifest.pickle')]
+        
+        for (index, path) in enumerate(paths):
+            file = open(path, 'w')
+            file.write('x' * 100)
+            file.close()
+            
+            # oldest first, except the manifest
+            os.utime(path, (1000 + index, 1000 + index))
+        
+        # entry c is in use, a is the least-recently used
+        evicted = evict_cache_entries(self.tmpdir, 300, [paths[3]])
+        
+        self.assertEqual(['host-00000001-a'], evicted)
+        self.assertEqual(['host-00000002-b.png', 'host-00000003-c.png', 'index.pickle', 'index.pickle.lock', 'manifest.pickle'], sorted(os.listdir(self.tmpdir)))
+        
+        # recent access keeps b around instead of c
+        record_cache_access(self.tmpdir, [paths[2]])
+        evicted = evict_cache_entries(self.tmpdir, 100)
+        
+        self.assertEqual(['host-00000003-c'], evicted)
+        self.assertTrue(os.path.exists(paths[2]))
+
+    def testCacheEviction2(self):
+        path = os.path.join(self.tmpdir, 'host-00000001-a.png')
+        open(path, 'w').write('x' * 100)
+        
+        # an entry locked by another compile stays put
+        lock = lock_cache_entry(path)
+        self.assertEqual([], evict_cache_entries(self.tmpdir, 0))
+        self.assertEqual(None, lock_cache_entry(path, False))
+        unlock_cache_entry(lock)
+        
+        self.assertEqual(['host-00000001-a'], evict_cache_entries(self.tmpdir, 0))
+        self.assertFalse(os.path.exists(path + '.lock'))
+        
+        # someone waiting on a lock file removed by eviction locks a new one
+        lock, locks = lock_cache_entry(path), []
+        thread = threading.Thread(target=lambda: locks.append(lock_cache_entry(path)))
+        thread.start()
+        sleep(.1)
+        
+        os.remove(path + '.lock')
+        unlock_cache_entry(lock)
+        thread.join()
+        
+        self.assertEqual(os.stat(path + '.lock').st_ino, os.fstat(locks[0].fileno()).st_ino)
+        unlock_cache_entry(locks[0])
+
+    def testCacheEviction3(self):
+        href = 'http://%s/one.png' % self.host
+        path = locally_cache_remote_file(href, self.tmpdir)
+        
+        # an entry used by a compile that's still running stays put
+        self.assertEqual([], evict_cache_entries(self.tmpdir, 0))
+        self.assertEqual('one', open(path).read())
+        
+        release_cache_entries(contexts.current)
+        self.assertEqual(1, len(evict_cache_entries(self.tmpdir, 0)))
+        self.assertFalse(os.path.exists(path))
+        
+        # ...along with its lock files
+        self.assertFalse(os.path.exists(path + '.lock'))
+        self.assertFalse(os.path.exists(path + '.use.lock'))
+
+    def testCacheEviction4(self):
+        zip_dir = tempfile.mkdtemp(prefix='cascadenik-tests-')
+        zip_path = os.path.join(zip_dir, 'shapes.zip')
+        zip_file = zipfile.ZipFile(zip_path, 'w')
+        
+        for ext in ('.shp', '.shx', '.dbf'):
+            zip_file.writestr('shapes' + ext, 'x' * 10)
+        
+        zip_file.close()
+        
+        try:
+            local = unzip_shapefile_into(zip_path, self.tmpdir)
+        finally:
+            shutil.rmtree(zip_dir)
+        
+        # unzipped parts are one entry, held like any other
+        self.assertEqual([], evict_cache_entries(self.tmpdir, 0))
+        self.assertTrue(os.path.exists(local + '.dbf'))
+        
+        release_cache_entries(contexts.current)
+        self.assertEqual([os.path.basename(local)], evict_cache_entries(self.tmpdir, 0))
+        self.assertFalse(os.path.exists(local + '.dbf'))
+
+    def testRemoteCacheLocking1(self):
+        self.server.headers['/one.png'] = {'Cache-Control': 'max-age=60'}
+        href = 'http://%s/one.png' % self.host
+        paths = []
+        
+        def fetch():
+            # each thread has its own context, like separate processes
+            contexts.current = CompileContext()
+            paths.append(locally_cache_remote_file(href, self.tmpdir))
+            contexts.current.connection_pool().close()
+        
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        
+        for thread in threads:
+            thread.start()
+        
+        for thread in threads:
+            thread.join()
+        
+        # only the first one to hold the lock downloads the file
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(1, len(set(paths)))
+        self.assertEqual('one', open(paths[0]).read())
+
+    def testOfflineCompile1(self):
+        self.server.files['/style.mss'] = 'Layer { polygon-fill: #999; }'
+        self.server.files['/points.csv'] = 'x,y\n0,0\n'
+        
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet src="style.mss"/>
+                <Layer>
+                    <Datasource>
+                        <Parameter name="type">ogr</Parameter>
+                        <Parameter name="layer">points</Parameter>
+                        <Parameter name="file">%s</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """
+        
+        dirs = Directories(self.tmpdir, self.tmpdir, 'http://%s/' % self.host)
+        
+        online = compile(s % 'points.csv', dirs)
+        offline = compile(s % 'points.csv', dirs, offline=True)
+        
+        # the offline compile is the same, and made no requests
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(online.layers[0].datasource.parameters['file'], offline.layers[0].datasource.parameters['file'])
+        self.assertEqual(2, len(read_manifest(self.tmpdir)))
+        
+        # all missing resources are listed at once
+        try:
+            compile(s.replace('style.mss', 'other.mss') % 'other.csv', dirs, offline=True)
+        except Exception, e:
+            self.assertTrue('/other.mss' in str(e))
+            self.assertFalse('/other.csv' in str(e))
+        else:
+            self.fail('Offline compile should have failed')
+        
+        try:
+            compile(s % 'other.csv', dirs, offline=True)
+        except Exception, e:
+            self.assertTrue('/other.csv' in str(e))
+        else:
+            self.fail('Offline compile should have failed')
+        
+        self.assertEqual(2, len(self.server.requests))
+
 class CompileXMLTests(unittest.TestCase):
 
     def setUp(self):
@@ -1934,6 +3193,17 @@ class CompileXMLTests(unittest.TestCase):
             </Map>
         """
         self.doCompile1(s)
+        
+        # layer rules generated in worker processes should be no different
+        self.doCompile1(s, jobs=2)
+        
+        # a caller-provided context keeps metrics about the compile
+        context = CompileContext()
+        self.doCompile1(s, context=context)
+        self.assertEqual(2, context.metrics['layers'])
+        self.assertEqual(1, context.metrics['generated layer rules'])
+        self.assertEqual(1, context.metrics['reused layer rules'])
+        self.assertEqual(3, context.metrics['shared styles'])
 
         # run the same test with a datasourcesconfig
         dscfg = """<?xml version="1.0"?>
@@ -2025,6 +3295,9 @@ layer_srs=%(other_srs)s
         self.assertEqual(os.path.basename(map.layers[0].datasource.parameters['file']), 'test.shp')
         self.assertEqual(map.layers[0].datasource.parameters['encoding'], 'latin1')
         self.assertEqual(map.layers[0].datasource.parameters['type'], 'shape')
+        
+        # both layers have the same class list, so they should share styles
+        self.assertEqual([s.name for s in map.layers[0].styles], [s.name for s in map.layers[1].styles])
         return map
 
     def testCompile2(self):